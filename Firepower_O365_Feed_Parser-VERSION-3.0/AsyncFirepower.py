@@ -0,0 +1,238 @@
+#
+# Asyncio flavour of the Firepower class, for fan-out workloads against the FMC APIs
+#
+
+# Import Libraries
+import asyncio
+import ssl
+import aiohttp
+import requests
+from Firepower import FirepowerError, nextPageOffset
+from RateLimiter import RateLimiter
+from TokenManager import TokenManager
+
+# A class to handle concurrent communication to the Firepower Management Console (FMC) APIs
+class AsyncFirepower:
+
+    def __init__(self, config_data, max_in_flight=None, rate_limiter=None):
+        self.fmc_ip     = config_data['FMC_IP']
+        self.fmc_user   = config_data['FMC_USER']
+        self.fmc_pass   = config_data['FMC_PASS']
+
+        # Token fetches are rare, they go through the regular requests session
+        auth_session = requests.Session()
+
+        if not config_data['SSL_VERIFY']:
+            requests.packages.urllib3.disable_warnings()
+            auth_session.verify = False
+            self.ssl_context = False
+        else:
+            auth_session.verify = config_data['SSL_CERT']
+            self.ssl_context = ssl.create_default_context(cafile=config_data['SSL_CERT'])
+
+        # FMC allows 10 concurrent connections per user
+        self.max_in_flight = max_in_flight or config_data.get('MAX_IN_FLIGHT', 10)
+
+        # Every call path to this FMC shares one rate limiter, unless we're given one
+        self.rate_limiter = rate_limiter or RateLimiter.shared(self.fmc_ip, config_data.get('RATE_LIMIT', 120))
+
+        # How often we retry a request the FMC throttled
+        self.max_retries = config_data.get('MAX_RETRIES', 3)
+
+        # Count the API calls we make
+        self.request_count = 0
+
+        self.tokens = TokenManager(self.fmc_ip, self.fmc_user, self.fmc_pass, auth_session, config_data.get('TOKEN_CACHE'))
+
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # Open the pooled HTTP session, bound to the running event loop
+    async def open(self):
+
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=self.ssl_context)
+
+        self.session = aiohttp.ClientSession(connector=connector, headers={'Content-Type': 'application/json'})
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        await self.getAuthToken()
+
+    async def close(self):
+
+        print('\nFMC async client sent {} API calls.'.format(self.request_count))
+        print(self.rate_limiter.report())
+
+        if self.session:
+            await self.session.close()
+
+    # Make sure we hold a valid Auth Token, without blocking the event loop on a token fetch
+    async def getAuthToken(self):
+
+        token = await asyncio.get_running_loop().run_in_executor(None, self.tokens.getToken)
+
+        # Set the Auth Token and FMC Domain UUID
+        self._auth_token = token['access_token']
+        self.fmc_domain = token['domain_uuid']
+
+    async def refreshAuthToken(self, access_token):
+
+        token = await asyncio.get_running_loop().run_in_executor(None, self.tokens.invalidate, access_token)
+
+        self._auth_token = token['access_token']
+        self.fmc_domain = token['domain_uuid']
+
+    # A function to send a request to the FMC, at most max_in_flight at a time
+    async def doApiCall(self, method, endpoint, json_data=None, params=None):
+
+        print('\nSending ' + str(method) + ' request to ' + str(endpoint) + ' endpoint on the FMC.')
+
+        # GET by default
+        if method not in ['POST', 'PUT', 'DELETE']:
+            method = 'GET'
+
+        async with self._semaphore:
+
+            token_refreshed = False
+            throttled = 0
+
+            while True:
+
+                await self.getAuthToken()
+
+                # Wait for our turn under the FMC rate limit
+                await self.rate_limiter.acquireAsync()
+
+                # Build URL for Object endpoint
+                endpoint_url = "https://{}/api/fmc_config/v1/domain/{}/{}".format(self.fmc_ip, self.fmc_domain, endpoint)
+
+                # Build new headers with the access token
+                headers = {'X-auth-access-token': self._auth_token}
+
+                try:
+                    async with self.session.request(method, endpoint_url, headers=headers, json=json_data, params=params) as http_req:
+                        self.request_count += 1
+
+                        # If the FMC rejects our token, refresh it and retry once
+                        if http_req.status == 401 and not token_refreshed:
+                            print('FMC rejected the Authentication Token, refreshing it and retrying...')
+                            await self.refreshAuthToken(self._auth_token)
+                            token_refreshed = True
+                            continue
+
+                        # If the FMC is throttling us, back off as long as it asks and retry
+                        if http_req.status == 429 and throttled < self.max_retries:
+                            wait = self.rate_limiter.throttle(http_req.headers.get('Retry-After'))
+                            print('FMC rate limit reached, retrying in {:.1f} seconds...'.format(wait))
+                            throttled += 1
+                            continue
+
+                        # Check to make sure the request was successful
+                        if http_req.status >= 200 and http_req.status < 300:
+                            print('Request succesfully sent to FMC.')
+                            return await http_req.json(content_type=None)
+
+                        response = await http_req.text()
+
+                except aiohttp.ClientError as err:
+                    print('Error posting request to FMC: ' + str(err))
+                    raise FirepowerError(None, str(err))
+
+                print("FMC Connection Failure - HTTP Return Code: {}\nResponse: {}".format(http_req.status, response))
+                raise FirepowerError(http_req.status, response)
+
+    # Create an object in the FMC
+    async def createObject(self, object_endpoint, object_json):
+
+        # Build the object specific URL
+        object_url = "object/" + object_endpoint
+
+        print("\nCreating object at the following endpoint: " + object_url)
+
+        return await self.doApiCall('POST', object_url, object_json)
+
+    # Delete an object in the FMC
+    async def deleteObject(self, object_endpoint, object_uuid):
+
+        # Build the object specific URL
+        object_url = "object/" + object_endpoint + '/' + object_uuid
+
+        print("\nDeleting the following object: " + object_url)
+
+        return await self.doApiCall('DELETE', object_url)
+
+    # Get an object from the FMC
+    async def getObject(self, object_endpoint, object_uuid=None):
+
+        # Build the object specific URL
+        object_url = "object/" + object_endpoint + '/' + object_uuid
+
+        print("\nRetrieving object from FMC: " + object_url)
+
+        return await self.doApiCall('GET', object_url)
+
+    # Get many objects from the FMC concurrently, in the order of the given UUIDs
+    async def getObjects(self, object_endpoint, object_uuids):
+
+        return await asyncio.gather(*[self.getObject(object_endpoint, object_uuid) for object_uuid in object_uuids])
+
+    # Iterate over every item of a collection endpoint (e.g. 'object/networks'), page by page
+    async def getAllItems(self, endpoint, limit=1000, expanded=True):
+
+        print("\nPaging through all items of: " + endpoint)
+
+        offset = 0
+
+        while offset is not None:
+            params = {'offset': offset, 'limit': limit, 'expanded': 'true' if expanded else 'false'}
+            page = await self.doApiCall('GET', endpoint, params=params)
+
+            for item in page.get('items', []):
+                yield item
+
+            offset = nextPageOffset(page, offset)
+
+    # Iterate over every object of an object type (e.g. 'networkgroups')
+    def getAllObjects(self, object_endpoint, limit=1000, expanded=True):
+
+        return self.getAllItems("object/" + object_endpoint, limit, expanded)
+
+    # Update an object in the FMC
+    async def updateObject(self, object_endpoint, object_uuid, object_json):
+
+        # Build the object specific URL
+        object_url = "object/" + object_endpoint + '/' + object_uuid
+
+        print("\nUpdating object at the following endpoint:  " + object_url)
+
+        return await self.doApiCall('PUT', object_url, object_json)
+
+    # Get Pending Deployments
+    async def getPendingDeployments(self):
+
+        # Build the deployment specific URL
+        deployment_url = "deployment/deployabledevices?expanded=true"
+
+        return await self.doApiCall('GET', deployment_url)
+
+    # Trigger Deployments
+    async def postDeployments(self, deployment_json):
+
+        # Build the deployment specific URL
+        deployment_url = "deployment/deploymentrequests"
+
+        return await self.doApiCall('POST', deployment_url, deployment_json)
+
+    # Get the status of an FMC task, e.g. the one a deployment request returns
+    async def getTaskStatus(self, task_id):
+
+        # Build the task specific URL
+        task_url = "job/taskstatuses/" + task_id
+
+        return await self.doApiCall('GET', task_url)
@@ -0,0 +1,149 @@
+#
+# Batched FMC policy deployments, tracked until every device has the new policies
+#
+
+# Import Libraries
+import time
+from Firepower import FirepowerError
+
+# How long we wait for a deployment before we give up on it
+DEFAULT_TIMEOUT = 30 * 60
+
+# Polling starts fast, then backs off, so short deployments are timed closely without hammering the FMC
+MIN_POLL_INTERVAL   = 5.0
+MAX_POLL_INTERVAL   = 30.0
+POLL_BACKOFF        = 1.5
+
+# The 'status' values of an FMC task (job/taskstatuses) that end it unsuccessfully, compared case-insensitively
+TASK_FAILED = ['FAILED', 'ABORTED']
+
+# A class to deploy all pending devices at once and follow the deployment through to the devices
+class DeploymentTracker:
+
+    def __init__(self, fmc, timeout=DEFAULT_TIMEOUT):
+        self.fmc        = fmc
+        self.timeout    = timeout
+
+        self.task_id        = None
+        self.task_status    = None
+        self.version        = None
+        self.started        = None
+
+        # Why we stopped polling early, if a poll failed
+        self.poll_error     = None
+
+        # Device UUID -> name, and how long each device took
+        self.devices    = {}
+        self.durations  = {}
+
+    # Devices with pending changes that can be deployed without interrupting traffic
+    def eligibleDevices(self):
+
+        devices = []
+
+        for item in self.fmc.getAllItems('deployment/deployabledevices'):
+            if item['canBeDeployed'] and item['trafficInterruption'] == "NO":
+                devices.append(item)
+
+        return devices
+
+    # Deploy every eligible device with a single DeploymentRequest. Returns the number of devices
+    def deploy(self):
+
+        devices = self.eligibleDevices()
+
+        if not devices:
+            print('There were zero pending deployments.')
+            return 0
+
+        # A request deploys the devices up to its version, so the newest version covers all of them
+        self.version = max(int(item['version']) for item in devices)
+
+        deployment_json = {
+            "type": "DeploymentRequest",
+            "version": str(self.version),
+            "forceDeploy": False,
+            "ignoreWarning": True,
+            "deviceList": [item['device']['id'] for item in devices],
+        }
+
+        self.started = time.time()
+
+        response = self.fmc.postDeployments(deployment_json)
+
+        # The FMC returns the task that tracks the deployment
+        self.task_id = response.get('metadata', {}).get('task', {}).get('id')
+
+        for item in devices:
+            self.devices[item['device']['id']] = item['device'].get('name', item['device']['id'])
+
+        print('Deployment of version {} requested for {} devices, task {}.'.format(self.version, len(self.devices), self.task_id))
+
+        return len(self.devices)
+
+    # Poll the task and the deployable devices until every device is deployed, the task failed or we time out
+    def wait(self):
+
+        interval = MIN_POLL_INTERVAL
+
+        while len(self.durations) < len(self.devices) and not self.taskFailed():
+
+            if time.time() - self.started > self.timeout:
+                print('Gave up on the deployment after {} seconds.'.format(self.timeout))
+                break
+
+            time.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+            # A failed poll only ends the wait, the devices not seen deployed are reported as such
+            try:
+                if self.task_id:
+                    self.task_status = self.fmc.getTaskStatus(self.task_id, exit_on_error=False).get('status')
+
+                # A device is done once it no longer waits for this version (or an older one)
+                pending = set()
+                for item in self.fmc.getAllItems('deployment/deployabledevices', exit_on_error=False):
+                    if int(item['version']) <= self.version:
+                        pending.add(item['device']['id'])
+
+            except FirepowerError as err:
+                self.poll_error = str(err)
+                print('Stopped following the deployment, polling the FMC failed: {}'.format(err))
+                break
+
+            elapsed = time.time() - self.started
+
+            for device_id in self.devices:
+                if device_id not in pending and device_id not in self.durations:
+                    self.durations[device_id] = elapsed
+                    print('Device {} deployed after {:.0f} seconds.'.format(self.devices[device_id], elapsed))
+
+            print('Deployment task {}: {}, {} of {} devices deployed.'.format(self.task_id, self.task_status, len(self.durations), len(self.devices)))
+
+        return self.durations
+
+    def taskFailed(self):
+
+        return (self.task_status or '').upper() in TASK_FAILED
+
+    def report(self):
+
+        lines = ['Deployment of version {} (task {}, last status {}):'.format(self.version, self.task_id, self.task_status)]
+
+        if self.poll_error:
+            lines.append('  Polling stopped early: {}'.format(self.poll_error))
+
+        for device_id, name in sorted(self.devices.items(), key=lambda device: device[1]):
+            if device_id in self.durations:
+                lines.append('  {}: deployed in {:.0f} seconds'.format(name, self.durations[device_id]))
+            else:
+                lines.append('  {}: not deployed'.format(name))
+
+        if self.durations:
+            lines.append('All devices deployed after {:.0f} seconds.'.format(max(self.durations.values())) if len(self.durations) == len(self.devices)
+                         else '{} of {} devices deployed.'.format(len(self.durations), len(self.devices)))
+
+        # Durations are only as precise as the polling
+        lines.append('Durations are measured from the request, polled every {:.0f} to {:.0f} seconds.'.format(MIN_POLL_INTERVAL, MAX_POLL_INTERVAL))
+
+        return '\n'.join(lines)
@@ -13,12 +13,75 @@
 # Import Libraries
 import json
 import requests
-from requests.auth import HTTPBasicAuth
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from RateLimiter import RateLimiter
+from TokenManager import TokenManager
+
+# Transient server errors doApiCall retries, with a backoff of SERVER_ERROR_BACKOFF * 2^retry seconds
+SERVER_ERRORS = [500, 502, 503, 504]
+SERVER_ERROR_BACKOFF = 0.5
+
+# Raised by clients that can't just exit() on an FMC failure (e.g. the asyncio client, or exit_on_error=False)
+class FirepowerError(Exception):
+
+    def __init__(self, status_code, response):
+        super().__init__('FMC request failed - HTTP Return Code: {}'.format(status_code))
+        self.status_code = status_code
+        self.response = response
+
+# The offset of the page after the given one, None if it was the last page
+def nextPageOffset(page, offset):
+
+    items = page.get('items', [])
+    paging = page.get('paging', {})
+
+    # FMC only sends paging.next while there are more pages
+    next_offset = offset + len(items)
+    if not paging.get('next') or not items:
+        return None
+    if 'count' in paging and next_offset >= paging['count']:
+        return None
+
+    return next_offset
+
+# Yield the items of a paged FMC collection as the pages arrive, following the paging offset.
+# fetch_page(offset) returns one page of JSON; with prefetch the next page is fetched in the
+# background while the caller works on the current one.
+def pageItems(fetch_page, prefetch=False):
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    try:
+        offset = 0
+        page = fetch_page(offset)
+
+        while True:
+            next_offset = nextPageOffset(page, offset)
+            has_next = next_offset is not None
+
+            next_page = executor.submit(fetch_page, next_offset) if has_next and executor else None
+
+            for item in page.get('items', []):
+                yield item
+
+            if not has_next:
+                break
+
+            page = next_page.result() if next_page else fetch_page(next_offset)
+            offset = next_offset
+
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
 
 # A class to handle communication to the Firepower Management Console (FMC) APIs
 class Firepower:
 
-    def __init__(self, config_data):
+    def __init__(self, config_data, rate_limiter=None):
         self.fmc_ip     = config_data['FMC_IP']
         self.fmc_user   = config_data['FMC_USER']
         self.fmc_pass   = config_data['FMC_PASS']
@@ -29,66 +92,151 @@ class Firepower:
         else:
             self.ssl_verify = config_data['SSL_CERT']
 
+        # Connection pool and retry settings (optional in the config)
+        self.pool_size      = config_data.get('POOL_SIZE', 10)
+        self.max_retries    = config_data.get('MAX_RETRIES', 3)
+
+        # Count the API calls we make, so we can compare them to the connections opened.
+        # Worker threads share the client, so the count is kept under a lock
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+        # Every call path to this FMC shares one rate limiter, unless we're given one
+        self.rate_limiter = rate_limiter or RateLimiter.shared(self.fmc_ip, config_data.get('RATE_LIMIT', 120))
+
+        self.buildSession()
+
+        # The token manager shares and refreshes the access token across all our scripts
+        self.tokens = TokenManager(self.fmc_ip, self.fmc_user, self.fmc_pass, self.session, config_data.get('TOKEN_CACHE'))
+
         self.getAuthToken()
 
-    def getAuthToken(self):
+    # Build a persistent HTTP session, so every FMC call reuses pooled keep-alive connections
+    def buildSession(self):
 
-        print('\nFetching Authentication Token from FMC...')
+        # Only retry failed connections here, those never reach the FMC. Anything the FMC answers
+        # is retried in doApiCall, so the retries go through the rate limiter like any other request
+        retries = Retry(total=self.max_retries,
+                        connect=self.max_retries,
+                        read=0,
+                        status=0,
+                        backoff_factor=0.5,
+                        raise_on_status=False)
 
-        # Build HTTP Authentication Instance
-        auth = HTTPBasicAuth(self.fmc_user, self.fmc_pass)
+        # Build the pooling adapter, one pool per FMC with pool_size connections
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retries)
 
-        # Build HTTP Headers
-        auth_headers = {'Content-Type': 'application/json'}
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
 
-        # Build URL for Authentication
-        auth_url = "https://{}/api/fmc_platform/v1/auth/generatetoken".format(self.fmc_ip)
+        # Also set per request, so REQUESTS_CA_BUNDLE in the environment can't override it
+        self.session.verify = self.ssl_verify
 
-        try:
-            http_req = requests.post(url=auth_url, auth=auth, headers=auth_headers, verify=self.ssl_verify)
+    # Get the number of connections opened vs. requests sent over the pooled session
+    def getConnectionStats(self):
 
-            print('FMC Auth Response: ' + str(http_req.headers))
+        opened = 0
+        sent = 0
 
-            # Set the Auth Token and FMC Domain UUID
-            self._auth_token = http_req.headers.get('X-auth-access-token', default=None)
-            self.fmc_domain = http_req.headers.get('DOMAIN_UUID', default=None)
+        # Walk every connection pool of every mounted adapter
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    opened += pool.num_connections
+                    sent += pool.num_requests
 
-            # If we didn't get a token, then something went wrong
-            if self._auth_token == None:
-                print('Authentication Token Not Found.  Exiting...')
-                exit()
+        return {
+            'api_calls': self.request_count,
+            'requests': sent,
+            'connections_opened': opened,
+            'connections_reused': max(sent - opened, 0),
+        }
 
-            print('Authentication Token Successfully Fetched.')
+    # Print the connection statistics and release the pooled connections
+    def close(self):
 
-        except Exception as err:
-            print('Error fetching auth token from FMC: ' + str(err))
-            exit()
-    
-    # A function to modify an Object in the FMC
-    def doApiCall(self, method, endpoint, json_data=None):
+        stats = self.getConnectionStats()
+
+        print('\nFMC connection stats: {} API calls, {} HTTP requests, {} connections opened, {} reused.'.format(
+            stats['api_calls'], stats['requests'], stats['connections_opened'], stats['connections_reused']))
+        print(self.rate_limiter.report())
+
+        self.session.close()
+
+    # Make sure we hold a valid Auth Token, the token manager reuses or refreshes it as needed
+    def getAuthToken(self):
+
+        token = self.tokens.getToken()
+
+        # Set the Auth Token and FMC Domain UUID
+        self._auth_token = token['access_token']
+        self.fmc_domain = token['domain_uuid']
+
+    # A function to modify an Object in the FMC, exits on failure unless exit_on_error is False, then it raises FirepowerError
+    def doApiCall(self, method, endpoint, json_data=None, params=None, exit_on_error=True):
         
         print('\nSending ' + str(method) + ' request to ' + str(endpoint) + ' endpoint on the FMC.')
 
-        # If there's no FMC Authentication Token, then fetch one
-        if self._auth_token == '':
-            self.getAuthToken()
+        http_req = None
+
+        try:
+            # Send the request over the pooled session - GET by default
+            if method not in ['POST', 'PUT', 'DELETE']:
+                method = 'GET'
 
-        # Build URL for Object endpoint
-        endpoint_url = "https://{}/api/fmc_config/v1/domain/{}/{}".format(self.fmc_ip, self.fmc_domain, endpoint)
+            token_refreshed = False
+            throttled = 0
+            server_errors = 0
 
-        # Build new headers with the access token
-        headers = {'Content-Type': 'application/json', 'X-auth-access-token': self._auth_token}
+            while True:
 
-        try:
-            # Take the appropriate action - GET by default
-            if method is 'POST':
-                http_req = requests.post(url=endpoint_url, headers=headers, json=json_data, verify=self.ssl_verify)
-            elif method is 'PUT':
-                http_req = requests.put(url=endpoint_url, headers=headers, json=json_data, verify=self.ssl_verify)
-            elif method is 'DELETE':
-                http_req = requests.delete(url=endpoint_url, headers=headers, json=json_data, verify=self.ssl_verify)
-            else:
-                http_req = requests.get(url=endpoint_url, headers=headers, json=json_data, verify=self.ssl_verify)
+                # Make sure the FMC Authentication Token is still valid
+                self.getAuthToken()
+
+                # Build URL for Object endpoint
+                endpoint_url = "https://{}/api/fmc_config/v1/domain/{}/{}".format(self.fmc_ip, self.fmc_domain, endpoint)
+
+                # Build new headers with the access token
+                headers = {'Content-Type': 'application/json', 'X-auth-access-token': self._auth_token}
+
+                # Wait for our turn under the FMC rate limit
+                self.rate_limiter.acquire()
+
+                http_req = self.session.request(method, url=endpoint_url, headers=headers, json=json_data, params=params, verify=self.ssl_verify)
+
+                with self._count_lock:
+                    self.request_count += 1
+
+                # If the FMC rejects our token, refresh it and retry once
+                if http_req.status_code == 401 and not token_refreshed:
+                    print('FMC rejected the Authentication Token, refreshing it and retrying...')
+                    http_req.close()
+                    self.tokens.invalidate(self._auth_token)
+                    token_refreshed = True
+                    continue
+
+                # If the FMC is throttling us, back off as long as it asks and retry
+                if http_req.status_code == 429 and throttled < self.max_retries:
+                    wait = self.rate_limiter.throttle(http_req.headers.get('Retry-After'))
+                    print('FMC rate limit reached, retrying in {:.1f} seconds...'.format(wait))
+                    http_req.close()
+                    throttled += 1
+                    continue
+
+                # If the FMC had a transient error, back off and retry
+                if http_req.status_code in SERVER_ERRORS and server_errors < self.max_retries:
+                    wait = SERVER_ERROR_BACKOFF * 2 ** server_errors
+                    print('FMC returned HTTP {}, retrying in {:.1f} seconds...'.format(http_req.status_code, wait))
+                    http_req.close()
+                    server_errors += 1
+                    time.sleep(wait)
+                    continue
+
+                break
 
             # Check to make sure the POST was successful
             if http_req.status_code >= 200 and http_req.status_code < 300:
@@ -96,17 +244,30 @@ class Firepower:
                 #print('HTTP Response: ' + str(http_req.text))
                 return http_req.json()
             else:
-                print("FMC Connection Failure - HTTP Return Code: {}\nResponse: {}".format(http_req.status_code, http_req.json()))
+                try:
+                    response = http_req.json()
+                except ValueError:
+                    response = http_req.text
+
+                print("FMC Connection Failure - HTTP Return Code: {}\nResponse: {}".format(http_req.status_code, response))
+
+                if not exit_on_error:
+                    raise FirepowerError(http_req.status_code, response)
                 exit()
 
+        except FirepowerError:
+            raise
         except Exception as err:
             print('Error posting request to FMC: ' + str(err))
+            if not exit_on_error:
+                raise FirepowerError(None, str(err))
             exit()
         finally:
+            # Hand the connection back to the pool rather than tearing it down
             if http_req: http_req.close()
 
     # Create an object in the FMC
-    def createObject(self, object_endpoint, object_json):
+    def createObject(self, object_endpoint, object_json, exit_on_error=True):
 
         # Build the object specific URL
         object_url = "object/" + object_endpoint
@@ -114,24 +275,37 @@ class Firepower:
         print("\nCreating object at the following endpoint: " + object_url)
 
         # Send the JSON to the FMC
-        return_json = self.doApiCall('POST', object_url, object_json)
+        return_json = self.doApiCall('POST', object_url, object_json, exit_on_error=exit_on_error)
+
+        return return_json
+
+    # Create up to 1000 objects in the FMC with one bulk request, the FMC creates all of them or none
+    def createObjects(self, object_endpoint, object_list, exit_on_error=True):
+
+        # Build the object specific URL
+        object_url = "object/" + object_endpoint
+
+        print("\nCreating {} objects at the following endpoint: {}".format(len(object_list), object_url))
+
+        # Send the JSON to the FMC
+        return_json = self.doApiCall('POST', object_url, object_list, params={'bulk': 'true'}, exit_on_error=exit_on_error)
 
         return return_json
     
     # Delete an object in the FMC
-    def deleteObject(self, object_endpoint, object_uuid):
+    def deleteObject(self, object_endpoint, object_uuid, exit_on_error=True):
 
         # Build the object specific URL
         object_url = "object/" + object_endpoint + '/' + object_uuid
 
         print("\nDeleting the following object: " + object_url)
 
-        return_json = self.doApiCall('DELETE', object_url)
+        return_json = self.doApiCall('DELETE', object_url, exit_on_error=exit_on_error)
 
         return return_json
     
     # Get an object from the FMC
-    def getObject(self, object_endpoint, object_uuid=None):
+    def getObject(self, object_endpoint, object_uuid=None, exit_on_error=True):
 
          # Build the object specific URL
         object_url = "object/" + object_endpoint + '/' + object_uuid
@@ -139,12 +313,29 @@ class Firepower:
         print("\nRetrieving object from FMC: " + object_url)
 
         # Get the object data
-        return_json = self.doApiCall('GET', object_url)
+        return_json = self.doApiCall('GET', object_url, exit_on_error=exit_on_error)
 
         return return_json
 
+    # Iterate over every item of a collection endpoint (e.g. 'object/networks'), page by page
+    def getAllItems(self, endpoint, limit=1000, expanded=True, prefetch=False, exit_on_error=True):
+
+        print("\nPaging through all items of: " + endpoint)
+
+        # Build the paging query for each page
+        def fetchPage(offset):
+            params = {'offset': offset, 'limit': limit, 'expanded': 'true' if expanded else 'false'}
+            return self.doApiCall('GET', endpoint, params=params, exit_on_error=exit_on_error)
+
+        return pageItems(fetchPage, prefetch)
+
+    # Iterate over every object of an object type (e.g. 'networkgroups')
+    def getAllObjects(self, object_endpoint, limit=1000, expanded=True, prefetch=False, exit_on_error=True):
+
+        return self.getAllItems("object/" + object_endpoint, limit, expanded, prefetch, exit_on_error)
+
     # Update an object in the FMC
-    def updateObject(self, object_endpoint, object_uuid, object_json):
+    def updateObject(self, object_endpoint, object_uuid, object_json, exit_on_error=True):
 
         # Build the object specific URL
         object_url = "object/" + object_endpoint + '/' + object_uuid
@@ -152,7 +343,7 @@ class Firepower:
         print("\nUpdating object at the following endpoint:  " + object_url)
 
         # PUT the object JSON data
-        return_json = self.doApiCall('PUT', object_url, object_json)
+        return_json = self.doApiCall('PUT', object_url, object_json, exit_on_error=exit_on_error)
 
         return return_json
 
@@ -176,4 +367,15 @@ class Firepower:
         # GET teh deployment JSON data
         return_json = self.doApiCall('POST', deployment_url, deployment_json)
 
-        return return_json
\ No newline at end of file
+        return return_json
+
+    # Get the status of an FMC task, e.g. the one a deployment request returns
+    def getTaskStatus(self, task_id, exit_on_error=True):
+
+        # Build the task specific URL
+        task_url = "job/taskstatuses/" + task_id
+
+        # GET the task JSON data
+        return_json = self.doApiCall('GET', task_url, exit_on_error=exit_on_error)
+
+        return return_json
@@ -0,0 +1,381 @@
+#
+# Helpers to fetch and parse the O365 endpoints web service feed
+#
+
+# Import Libraries
+import codecs
+import ipaddress
+import json
+import os
+import requests
+import sys
+import time
+
+# Size of the chunks we read from the feed
+CHUNK_SIZE = 64 * 1024
+
+# Properties of an endpoint set we keep next to its IPs and URLs, for filtering
+ENDPOINT_SET_FIELDS = ['serviceArea', 'category', 'required']
+
+# Service areas and categories the web service sorts the endpoint sets into
+SERVICE_AREAS = ['Common', 'Exchange', 'SharePoint', 'Skype']
+CATEGORIES = ['Optimize', 'Allow', 'Default']
+
+# An order preserving list that drops duplicates, backed by a set for O(1) lookups
+class UniqueList:
+
+    def __init__(self, items=()):
+        self._items = []
+        self._seen = set()
+
+        for item in items:
+            self.add(item)
+
+    # Append the item, unless we already have it. Returns True if it was added
+    def add(self, item):
+
+        if item in self._seen:
+            return False
+
+        self._seen.add(item)
+        self._items.append(item)
+
+        return True
+
+    def __contains__(self, item):
+        return item in self._seen
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+# Read a file in chunks, e.g. to feed a cached response to iterJsonArray()
+def iterFileChunks(path, chunk_size=CHUNK_SIZE):
+
+    with open(path, 'rb') as input_file:
+        while True:
+            chunk = input_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+# An on-disk cache of web service responses, revalidated with conditional requests (ETag / Last-Modified)
+class FeedCache:
+
+    def __init__(self, cache_dir, session=None):
+        self.cache_dir  = cache_dir
+        self.session    = session or requests.Session()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Statistics, so we can report what the cache saved us
+        self.fetched            = 0
+        self.not_modified       = 0
+        self.bytes_downloaded   = 0
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    # Conditional GET of the URL, the response body is cached under the given name.
+    # Returns the path of the fresh or the still valid cached body, None if the request failed.
+    def get(self, name, url):
+
+        body_path = self.path(name)
+
+        # Only revalidate when we still hold the body the validators belong to
+        validators = self._loadValidators(name) if os.path.isfile(body_path) else {}
+
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        try:
+            req = self.session.get(url, headers=headers, stream=True)
+        except requests.RequestException as err:
+            sys.stdout.write("Failed to fetch %s: %s\n" % (name, err))
+            return None
+
+        try:
+
+            # Nothing changed, the cached body is still current
+            if req.status_code == 304:
+                self.not_modified += 1
+                sys.stdout.write("%s not modified, using the cached copy.\n" % name)
+                return body_path
+
+            if req.status_code != 200:
+                sys.stdout.write("Failed to fetch %s - HTTP Return Code: %d\n" % (name, req.status_code))
+                return None
+
+            # Stream the body to disk, only replacing the cached copy once it is complete
+            temp_path = body_path + '.tmp'
+
+            with open(temp_path, 'wb') as output_file:
+                for chunk in req.iter_content(chunk_size=CHUNK_SIZE):
+                    output_file.write(chunk)
+                    self.bytes_downloaded += len(chunk)
+
+            os.replace(temp_path, body_path)
+
+            self._saveValidators(name, {
+                'url': url,
+                'etag': req.headers.get('ETag'),
+                'last_modified': req.headers.get('Last-Modified'),
+                'fetched': time.time(),
+            })
+
+            self.fetched += 1
+
+            return body_path
+
+        except requests.RequestException as err:
+            sys.stdout.write("Failed to fetch %s: %s\n" % (name, err))
+            return None
+
+        finally:
+            req.close()
+
+    # Forget a cached body, e.g. when it turned out to be unusable
+    def discard(self, name):
+
+        for path in [self.path(name), self.path(name + '.meta')]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def report(self):
+
+        return 'Feed cache: %d responses downloaded (%d bytes), %d not modified.' % (self.fetched, self.bytes_downloaded, self.not_modified)
+
+    def _loadValidators(self, name):
+
+        try:
+            with open(self.path(name + '.meta'), 'r') as meta_file:
+                return json.loads(meta_file.read())
+        except (IOError, ValueError):
+            return {}
+
+    def _saveValidators(self, name, validators):
+
+        temp_path = self.path(name + '.meta.tmp')
+
+        with open(temp_path, 'w') as output_file:
+            json.dump(validators, output_file, indent=4)
+
+        os.replace(temp_path, self.path(name + '.meta'))
+
+# Yield the elements of a top level JSON array as they arrive, from an iterable of byte chunks.
+# Only the element being decoded is held in memory, never the whole document.
+def iterJsonArray(chunks):
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    buffer = ''
+    started = False
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        pos = 0
+
+        while True:
+
+            # Skip whitespace and the separators between elements
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+
+            if pos >= len(buffer):
+                break
+
+            # The document has to be an array
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array, got: ' + buffer[pos:pos + 20])
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            # Stop at an incomplete element and wait for the next chunk
+            try:
+                element, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+
+            yield element
+
+        buffer = buffer[pos:]
+
+    raise ValueError('JSON array is truncated')
+
+# Collapse adjacent and overlapping prefixes into the fewest networks covering exactly the same
+# addresses, separately for IPv4 and IPv6. Entries that aren't prefixes are passed through as is.
+def aggregateNetworks(ip_list):
+
+    networks = {4: [], 6: []}
+    others = []
+
+    for ip in ip_list:
+        try:
+            network = ipaddress.ip_network(ip, strict=False)
+            networks[network.version].append(network)
+        except ValueError:
+            sys.stdout.write("Not aggregating '%s', it is not an IP prefix.\n" % ip)
+            others.append(ip)
+
+    aggregated = []
+
+    for version in [4, 6]:
+        for network in ipaddress.collapse_addresses(networks[version]):
+            aggregated.append(str(network))
+
+    return aggregated + others
+
+# Normalise an IP literal, so '1.2.3.4', '1.2.3.4/32' and FMC's Host form compare equal
+def normalizeIp(value):
+
+    try:
+        return str(ipaddress.ip_network(value, strict=False))
+    except ValueError:
+        return value
+
+# Compare the literals FMC holds with the ones we want, on the given key ('value' or 'url').
+# Returns the (added, removed) values.
+def diffLiterals(current_literals, desired_literals, key, normalize=None):
+
+    if normalize is None:
+        normalize = lambda value: value
+
+    current = set(normalize(literal[key]) for literal in current_literals if key in literal)
+    desired = set(normalize(literal[key]) for literal in desired_literals)
+
+    return sorted(desired - current), sorted(current - desired)
+
+# Index the items of the endpoints feed by endpoint set id, keeping only their IPs, URLs and the fields we filter on
+def buildEndpointSets(items):
+
+    endpoint_sets = {}
+
+    for item in items:
+        endpoint_set = {'ips': list(item.get('ips', [])), 'urls': list(item.get('urls', []))}
+
+        for field in ENDPOINT_SET_FIELDS:
+            if field in item:
+                endpoint_set[field] = item[field]
+
+        endpoint_sets[str(item['id'])] = endpoint_set
+
+    return endpoint_sets
+
+# Yield the endpoint sets in feed order, only those of the given service areas and categories (empty for all)
+def selectEndpointSets(endpoint_sets, service_areas=(), categories=()):
+
+    for set_id in sorted(endpoint_sets, key=int):
+
+        endpoint_set = endpoint_sets[set_id]
+
+        if service_areas and endpoint_set.get('serviceArea') not in service_areas:
+            continue
+        if categories and endpoint_set.get('category') not in categories:
+            continue
+
+        yield endpoint_set
+
+# Keep the IPs of the given address family: 'ipv4', 'ipv6' or 'all'
+def filterFamily(ips, family):
+
+    if family == 'ipv4':
+        return [ip for ip in ips if ':' not in ip]
+    if family == 'ipv6':
+        return [ip for ip in ips if ':' in ip]
+
+    return list(ips)
+
+# Apply the records of the 'changes' web method to endpoint sets from buildEndpointSets(), in place.
+# Raises ValueError when a record doesn't fit the sets, the caller should then pull the full feed.
+def applyChanges(endpoint_sets, changes):
+
+    if not isinstance(changes, list):
+        raise ValueError('Expected a list of change records, got: ' + str(changes)[:100])
+
+    # Replay the changes in the order they were published
+    for change in sorted(changes, key=lambda change: (str(change.get('version', '')), change.get('id', 0))):
+
+        if 'endpointSetId' not in change:
+            raise ValueError('Change record %s has no endpoint set id' % change.get('id'))
+
+        set_id = str(change['endpointSetId'])
+        disposition = change.get('disposition')
+
+        # A new endpoint set starts out empty, anything else has to be known already
+        if disposition == 'add':
+            endpoint_sets.setdefault(set_id, {'ips': [], 'urls': []})
+        elif set_id not in endpoint_sets:
+            raise ValueError('Change record %s refers to unknown endpoint set %s' % (change.get('id'), set_id))
+
+        if disposition == 'remove':
+            del endpoint_sets[set_id]
+            continue
+
+        endpoint_set = endpoint_sets[set_id]
+
+        # The properties that changed, all of them for a new endpoint set
+        for field in ENDPOINT_SET_FIELDS:
+            if field in change.get('current', {}):
+                endpoint_set[field] = change['current'][field]
+
+        if 'serviceArea' not in endpoint_set:
+            raise ValueError('Change record %s leaves endpoint set %s without a service area' % (change.get('id'), set_id))
+
+        for key in ['ips', 'urls']:
+
+            for value in change.get('remove', {}).get(key, []):
+                if value in endpoint_set[key]:
+                    endpoint_set[key].remove(value)
+
+            for value in change.get('add', {}).get(key, []):
+                if value not in endpoint_set[key]:
+                    endpoint_set[key].append(value)
+
+    return endpoint_sets
+
+# Spread the values over shards of at most shard_size values, keeping values in the shard they are already in.
+# Values no longer wanted are dropped, new values fill the shards with room first, then new shards.
+# Returns the new contents of every shard, the first len(current_shards) of them in the same order.
+def assignShards(current_shards, values, shard_size):
+
+    wanted = set(values)
+    assigned = set()
+    shards = []
+
+    for current_shard in current_shards:
+        shard = []
+
+        for value in current_shard:
+            if value in wanted and value not in assigned and len(shard) < shard_size:
+                shard.append(value)
+                assigned.add(value)
+
+        shards.append(shard)
+
+    new_values = [value for value in UniqueList(values) if value not in assigned]
+    position = 0
+
+    # Top up the shards that have room
+    for shard in shards:
+        room = shard_size - len(shard)
+        shard.extend(new_values[position:position + room])
+        position += room
+
+    # Put the rest in new shards
+    while position < len(new_values):
+        shards.append(new_values[position:position + shard_size])
+        position += shard_size
+
+    return shards
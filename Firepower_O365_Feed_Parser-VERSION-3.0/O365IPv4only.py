@@ -12,376 +12,13 @@
 # IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 # or implied.
 
-import getpass
-import json
-import os
-import requests
-import sys
-import datetime
-import time
-import uuid
-import ciscosparkapi
-# import supporting functions from additional file
-from Firepower import Firepower
+# Runs the O365WebServiceParser with IPv4 addresses only, for every target in config.json that doesn't set its own "FAMILY".
+# Instances, service areas and FMC objects are all configured through the "TARGETS" of config.json.
+import O365WebServiceParser
 
-# Config Paramters
-CONFIG_FILE     = "config.json"
-CONFIG_DATA     = None
-
-# Object Prefix
-OBJECT_PREFIX = ""
-
-# A function to load CONFIG_DATA from file
-def loadConfig():
-
-    global CONFIG_DATA
-
-    sys.stdout.write("\n")
-    sys.stdout.write("Loading config data...")
-    sys.stdout.write("\n")
-
-    # If we have a stored config file, then use it, otherwise create an empty one
-    if os.path.isfile(CONFIG_FILE):
-
-        # Open the CONFIG_FILE and load it
-        with open(CONFIG_FILE, 'r') as config_file:
-            CONFIG_DATA = json.loads(config_file.read())
-
-        sys.stdout.write("Config loading complete.")
-        sys.stdout.write("\n")
-        sys.stdout.write("\n")
-
-    else:
-
-        sys.stdout.write("Config file not found, loading empty defaults...")
-        sys.stdout.write("\n")
-        sys.stdout.write("\n")
-
-        # Set the CONFIG_DATA defaults
-        CONFIG_DATA = {
-            "FMC_IP": "",
-            "FMC_USER": "",
-            "FMC_PASS": "",
-            "IP_UUID": "",
-            "URL_UUID": "",
-            "SERVICE":  False,
-            "SSL_VERIFY": False,
-            "SSL_CERT": "/path/to/certificate",
-            "AUTO_DEPLOY": False,
-            "VERSION":  0,
-            "WEBEX_ACCESS_TOKEN": "",
-            "WEBEX_ROOM_ID": "",
-        }
-
-# A function to store CONFIG_DATA to file
-def saveConfig():
-
-    sys.stdout.write("Saving config data...")
-    sys.stdout.write("\n")
-
-    with open(CONFIG_FILE, 'w') as output_file:
-        json.dump(CONFIG_DATA, output_file, indent=4)
-
-# A function to deploy pending policy pushes
-def DeployPolicies(fmc):
-
-    # Get pending deployments
-    pending_deployments = fmc.getPendingDeployments()
-
-    # Setup a dict to hold our deployments
-    deployments = {}
-
-    # See if there are pending deployments
-    if pending_deployments['paging']['count'] > 0:
-
-        # Iterate through pending deployments
-        for item in pending_deployments['items']:
-
-            # Only get ones that can be deployed
-            if item['canBeDeployed']:
-
-                # Only get ones that don't cause traffic interruption
-                if item['trafficInterruption'] == "NO":
-
-                    # If there are multiple devices, append them
-                    if item['version'] in deployments:
-                        device_list = deployments[item['version']]
-                        device_list.append(item['device']['id'])
-                        deployments[item['version']] = device_list
-                    else:
-                        deployments[item['version']] = [item['device']['id']]
-
-        # Build JSON for each of our deployments
-        for version, devices in deployments.items():
-
-            deployment_json = {
-                "type": "DeploymentRequest",
-                "version": version,
-                "forceDeploy": False,
-                "ignoreWarning": True,
-                "deviceList": devices,
-            }
-
-            fmc.postDeployments(deployment_json)
-
-        sys.stdout.write("All pending deployments have been requested.\n")
-    
-    else:
-
-        sys.stdout.write("There were zero pending deployments.\n")
-
-# Function that can be used to schedule the O365WebServiceParser to refresh at intervals. Caution: this creates an infinite loop.
-# Takes the O365WebServiceParser function and the interval as parameters. 
-def intervalScheduler(function, interval):
-
-    # user feedback
-    sys.stdout.write("\n")
-    sys.stdout.write("O365 Web Service Parser will be refreshed every %d seconds. Please use ctrl-C to exit.\n" %interval)
-    sys.stdout.write("\n")
-
-    # interval loop, unless keyboard interrupt
-    try:
-        while True:
-            function()
-            # get current time, for user feedback
-            date_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            sys.stdout.write("\n")
-            sys.stdout.write("[%s] O365 Web Service Parser executed by IntervalScheduler, current interval is %d seconds. Please use ctrl-C to exit.\n" % (date_time, interval))
-            sys.stdout.write("\n")
-            # sleep for X amount of seconds and then run again. Caution: this creates an infinite loop to check the Web Service Feed for changes
-            time.sleep(interval)
-
-    # handle keyboard interrupt
-    except (KeyboardInterrupt, SystemExit):
-        sys.stdout.write("\n")
-        sys.stdout.write("\n")
-        sys.stdout.write("Exiting... O365 Web Service Parser will not be automatically refreshed anymore.\n")
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        pass
-
-
-# function to parse the Web Service, so that it can be called iteratively (e.g by the scheduler function)
-def WebServiceParser():
-
-    # Instantiate a Firepower object
-    fmc = Firepower(CONFIG_DATA)
-
-    # If there's no defined Network Object, make one, then store the UUID - else, get the current object
-    if CONFIG_DATA['IP_UUID'] is '':
-
-        # Create the JSON to submit
-        object_json = {
-            'name': OBJECT_PREFIX + 'O365_Web_Service_IPs',
-            'type': 'NetworkGroup',
-            'overridable': True,
-        }
-
-        # Create the Network Group object in the FMC
-        ip_group_object = fmc.createObject('networkgroups', object_json)
-
-        # Save the UUID of the object
-        CONFIG_DATA['IP_UUID'] = ip_group_object['id']
-        saveConfig()
-    else:
-        # Get the Network Group object of the specified UUID
-        ip_group_object = fmc.getObject('networkgroups', CONFIG_DATA['IP_UUID'])
-
-    # If there's no defined URL Object, make one, then store the UUID
-    if CONFIG_DATA['URL_UUID'] is '':
-
-        # Create the JSON to submit
-        object_json = {
-            'name': OBJECT_PREFIX + 'O365_Web_Service_URLs',
-            'type': 'UrlGroup',
-            'overridable': True,
-        }
-
-        # Create the URL Group object in the FMC
-        url_group_object = fmc.createObject('urlgroups', object_json)
-
-        # Save the UUID of the object
-        CONFIG_DATA['URL_UUID'] = url_group_object['id']
-        saveConfig()
-    else:
-        # Get the URL Group object of the specified UUID
-        url_group_object = fmc.getObject('urlgroups', CONFIG_DATA['URL_UUID'])
-
-    # Get the latest version of the loaded feed
-    latestVersion = CONFIG_DATA['VERSION']
-
-    # create GUID for GET requests
-    clientRequestId = str(uuid.uuid4())
-
-    # URL needed to check latest version
-    webServiceVersionURL = "https://endpoints.office.com/version?clientrequestid="
-
-    # assemble URL for get request for version 
-    getURLVersion = webServiceVersionURL + clientRequestId
-
-    # do GET request 
-    reqVersion = requests.get(getURLVersion)
-
-    # grab output in JSON format
-    version = reqVersion.json()
-
-    # loop through version list and grab Wordwide list version
-    for element in version:
-        if(element['instance'] == 'Worldwide'):
-            newVersion = int(element['latest'])
-
-    # if the version did not change, the Web Service feed was not updated. 
-    if(newVersion == latestVersion):
-
-        # user feed back
-        sys.stdout.write("\n")
-        sys.stdout.write("Web Service List has NOT been updated since the last load, no update needed!\n") 
-        sys.stdout.write("\n")
-
-    # check if there is a newer version 
-    if(newVersion > latestVersion):
-
-        # update version and save the config
-        CONFIG_DATA['VERSION'] = newVersion
-
-        # user feedback
-        sys.stdout.write("\n")
-        sys.stdout.write("New version of Office 365 worldwide commercial service instance endpoints detected: %(version)s" % {'version': CONFIG_DATA['VERSION']})
-        sys.stdout.write("\n")
-
-        ### PARSE JSON FEED ###
-
-        # URL needed for the worldwide web service feed
-        webServiceURL = "https://endpoints.office.com/endpoints/worldwide?NoIPv6=true&clientrequestid="
-
-        # assemble URL for get request
-        getURL = webServiceURL + clientRequestId
-
-        # do GET request 
-        req = requests.get(getURL)  
-
-        # initiate lists to be filled with addresses
-        URL_List = []
-        IP_List = []
-
-        # error handling if true then the request was HTTP 200, so successful 
-        if(req.status_code == 200):
-
-            # grab output in JSON format
-            output = req.json()
-
-            # iterate through each 'item' in the JSON data
-            for item in output:
-
-                # make sure URLs exist in the item
-                if 'urls' in item:
-                    
-                    # iterate through all URLs in each item
-                    for url in item['urls']:
-
-                        # remove asterisks to put URLs into Firepower format 
-                        #   (https://www.cisco.com/c/en/us/support/docs/security/firesight-management-center/118852-technote-firesight-00.html#anc14)
-                        url = url.replace('*','')
-
-                        # if the URL hasn't already been appended, then append it
-                        if url not in URL_List:
-                            URL_List.append(url)
-
-                # make sure IPs exist in the item
-                if 'ips' in item:
-
-                    # iterate through all IPs in each item
-                    for ip in item['ips']:
-
-                        # if the IP hasn't already been appended, then append it
-                        if ip not in IP_List:
-                            IP_List.append(ip)
-
-        # Reset the fetched Network Group object to clear the 'literals'
-        ip_group_object['literals'] = []
-        ip_group_object.pop('links', None)
-
-        # Add all the fetched IPs to the 'literals'of the Network Group object
-        for ip_address in IP_List:
-            ip_group_object['literals'].append({'type': 'Network', 'value': ip_address})
-
-        # Update the NetworkGroup object
-        fmc.updateObject('networkgroups', CONFIG_DATA['IP_UUID'], ip_group_object)
-
-        # Reset the fetched URL Group object to clear the 'literals'
-        url_group_object['literals'] = []
-        url_group_object.pop('links', None)
-
-        # Add all the fetched URLs to the 'literals' of the URL Group object
-        for url in URL_List:
-            url_group_object['literals'].append({'type': 'Url', 'url': url})
-
-        # Update the UrlGroup object
-        fmc.updateObject('urlgroups', CONFIG_DATA['URL_UUID'], url_group_object)
-
-        # user feed back
-        sys.stdout.write("\n")
-        sys.stdout.write("Web Service List has been successfully updated!\n")
-        sys.stdout.write("\n")
-
-        saveConfig()
-
-        # If the user wants us to deploy policies, then do it
-        if CONFIG_DATA['AUTO_DEPLOY']:
-            DeployPolicies(fmc)
-        
-        # if Webex Teams tokens set, then send message to Webex room
-        if CONFIG_DATA['WEBEX_ACCESS_TOKEN'] is '' or CONFIG_DATA['WEBEX_ROOM_ID'] is '':
-
-            # user feed back
-            sys.stdout.write("Webex Teams not set.\n")
-            sys.stdout.write("\n")
-        else:
-
-            # adjust the Webex message based on the config
-            if CONFIG_DATA['AUTO_DEPLOY']:
-                message_text = "Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment was initiated..."
-            else:
-                message_text = "Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment is required."
-
-            # instantiate the Webex handler with the access token
-            webex = ciscosparkapi.CiscoSparkAPI(CONFIG_DATA['WEBEX_ACCESS_TOKEN'])
-
-            # post a message to the specified Webex room
-            message = webex.messages.create(CONFIG_DATA['WEBEX_ROOM_ID'], text=message_text)
-
-##############END PARSE FUNCTION##############START EXECUTION SCRIPT##############
+O365WebServiceParser.DEFAULT_FAMILY = 'ipv4'
 
 if __name__ == "__main__":
-
-    # Load config data from file
-    loadConfig()
-
-    # If not hard coded, get the FMC IP, Username, and Password
-    if CONFIG_DATA['FMC_IP'] is '':
-        CONFIG_DATA['FMC_IP'] = input("FMC IP Address: ")
-    if CONFIG_DATA['FMC_USER'] is '':
-        CONFIG_DATA['FMC_USER'] = input("FMC Username: ")
-    if CONFIG_DATA['FMC_PASS'] is '':
-        CONFIG_DATA['FMC_PASS'] = getpass.getpass("FMC Password: ")
-
-    # Save the FMC data
-    saveConfig()
-
-    try:
-        if CONFIG_DATA['SERVICE']:
-            # Calls the intervalScheduler for automatic refreshing (pass O365WebServiceParser function and interval in seconds (1 hour = 3600 seconds))
-            intervalScheduler(WebServiceParser, 3600) #set to 1 hour
-        else:
-            # Execute O365WebServiceParser just once
-            WebServiceParser()
-
-    except (KeyboardInterrupt, SystemExit):
-        sys.stdout.write("\n")
-        sys.stdout.write("\n")
-        sys.stdout.write("Exiting...\n")
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        pass
+    O365WebServiceParser.main()
 
 # end of script
@@ -12,25 +12,49 @@
 # IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 # or implied.
 
+import copy
 import getpass
 import json
 import os
 import requests
 import sys
 import datetime
+import threading
 import time
 import uuid
 import ciscosparkapi
+from concurrent.futures import ThreadPoolExecutor
 # import supporting functions from additional file
-from Firepower import Firepower
+from Firepower import Firepower, FirepowerError
+from DeploymentTracker import DeploymentTracker
+from O365Feed import UniqueList, FeedCache, iterJsonArray, iterFileChunks, aggregateNetworks, diffLiterals, normalizeIp, buildEndpointSets, applyChanges, assignShards, filterFamily, selectEndpointSets, SERVICE_AREAS, CATEGORIES
 
 # Config Paramters
 CONFIG_FILE     = "config.json"
 CONFIG_DATA     = None
 
+# The IP and URL pipelines run in parallel, only one of them may write the config at a time
+CONFIG_LOCK     = threading.Lock()
+
 # Object Prefix
 OBJECT_PREFIX = ""
 
+# Address family of the targets that don't set their own "FAMILY": 'all', 'ipv4' or 'ipv6'
+DEFAULT_FAMILY = 'all'
+
+# A target is a set of FMC group objects, filled from the feed of one O365 instance
+def defaultTarget():
+
+    return {
+        "NAME": "O365_Web_Service",
+        "INSTANCE": "Worldwide",
+        "SERVICE_AREAS": [],
+        "CATEGORIES": [],
+        "IP_UUID": "",
+        "URL_UUID": "",
+        "VERSION": 0,
+    }
+
 # A function to load CONFIG_DATA from file
 def loadConfig():
 
@@ -51,6 +75,30 @@ def loadConfig():
         sys.stdout.write("\n")
         sys.stdout.write("\n")
 
+        # Configs from before targets describe a single Worldwide target
+        if 'TARGETS' not in CONFIG_DATA:
+
+            target = defaultTarget()
+
+            for key in ['IP_UUID', 'URL_UUID', 'VERSION']:
+                if key in CONFIG_DATA:
+                    target[key] = CONFIG_DATA.pop(key)
+
+            CONFIG_DATA['TARGETS'] = [target]
+
+        # Targets only need to set what differs from the defaults
+        for target in CONFIG_DATA['TARGETS']:
+            for key, value in defaultTarget().items():
+                target.setdefault(key, value)
+
+            # A typo in a filter would silently leave the objects empty
+            for service_area in target['SERVICE_AREAS']:
+                if service_area not in SERVICE_AREAS:
+                    sys.stdout.write("Unknown service area '%s' in target %s, expected one of: %s\n" % (service_area, target['NAME'], ', '.join(SERVICE_AREAS)))
+            for category in target['CATEGORIES']:
+                if category not in CATEGORIES:
+                    sys.stdout.write("Unknown category '%s' in target %s, expected one of: %s\n" % (category, target['NAME'], ', '.join(CATEGORIES)))
+
     else:
 
         sys.stdout.write("Config file not found, loading empty defaults...")
@@ -62,13 +110,21 @@ def loadConfig():
             "FMC_IP": "",
             "FMC_USER": "",
             "FMC_PASS": "",
-            "IP_UUID": "",
-            "URL_UUID": "",
+            "TARGETS": [defaultTarget()],
             "SERVICE":  False,
             "SSL_VERIFY": False,
             "SSL_CERT": "/path/to/certificate",
+            "POOL_SIZE": 10,
+            "MAX_RETRIES": 3,
             "AUTO_DEPLOY": False,
-            "VERSION":  0,
+            "DEPLOY_WAIT": True,
+            "DEPLOY_TIMEOUT": 1800,
+            "AGGREGATE_IPS": False,
+            "SHARD_SIZE": 0,
+            "DELTA_SYNC": True,
+            "O365_BASE_URL": "https://endpoints.office.com",
+            "CACHE_DIR": "o365_cache",
+            "ENDPOINT_CACHE": "o365_endpoints.json",
             "WEBEX_ACCESS_TOKEN": "",
             "WEBEX_ROOM_ID": "",
         }
@@ -79,58 +135,475 @@ def saveConfig():
     sys.stdout.write("Saving config data...")
     sys.stdout.write("\n")
 
-    with open(CONFIG_FILE, 'w') as output_file:
-        json.dump(CONFIG_DATA, output_file, indent=4)
+    with CONFIG_LOCK:
+        with open(CONFIG_FILE, 'w') as output_file:
+            json.dump(CONFIG_DATA, output_file, indent=4)
+
+# The cache directory lives next to the config file
+def cacheDir():
+
+    return os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), CONFIG_DATA.get('CACHE_DIR', 'o365_cache'))
+
+def endpointCachePath():
+
+    return os.path.join(cacheDir(), CONFIG_DATA.get('ENDPOINT_CACHE', 'o365_endpoints.json'))
+
+# The web service, can be pointed at a local stand-in for testing
+def baseURL():
+
+    return CONFIG_DATA.get('O365_BASE_URL', 'https://endpoints.office.com').rstrip('/')
+
+# A function to load the endpoint sets of the last loaded version of each instance
+def loadEndpointCache():
+
+    cache_path = endpointCachePath()
+
+    if not os.path.isfile(cache_path):
+        return {}
+
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.loads(cache_file.read())
+    except ValueError:
+        sys.stdout.write("Endpoint cache %s is corrupt, ignoring it.\n" % cache_path)
+        return {}
+
+    # A cache from before targets holds a single instance, it is simply rebuilt
+    return cache.get('instances', {})
+
+# A function to store the endpoint sets, atomically so a crash can't leave half a cache
+def saveEndpointCache(endpoint_cache):
+
+    cache_path = endpointCachePath()
+    temp_path = cache_path + '.tmp'
+
+    with open(temp_path, 'w') as output_file:
+        json.dump({'instances': endpoint_cache}, output_file)
+
+    os.replace(temp_path, cache_path)
+
+# A function to pull and parse the full feed of an instance, returns its endpoint sets or None on failure
+def fetchEndpointSets(feed_cache, instance, clientRequestId):
+
+    ### PARSE JSON FEED ###
+
+    # The full feed, IPv4 and IPv6, is cached once per instance and filtered per target
+    feedName = "endpoints_%s.json" % instance.lower()
+
+    # URL needed for the web service feed of the instance
+    webServiceURL = baseURL() + "/endpoints/" + instance.lower() + "?clientrequestid="
+
+    # assemble URL for get request
+    getURL = webServiceURL + clientRequestId
+
+    # do a conditional GET request, streaming the feed to the cache rather than loading it whole
+    feed_path = feed_cache.get(feedName, getURL)
+
+    if feed_path is None:
+        return None
+
+    # index each 'item' in the JSON data by endpoint set, reading the cached feed in chunks
+    try:
+        endpoint_sets = buildEndpointSets(iterJsonArray(iterFileChunks(feed_path)))
+    except (ValueError, KeyError) as err:
+        sys.stdout.write("Cached Web Service feed is unusable (%s), discarding it.\n" % err)
+        feed_cache.discard(feedName)
+        return None
+
+    # user feedback
+    sys.stdout.write("Full Web Service feed of the %s instance loaded, %d endpoint sets.\n" % (instance, len(endpoint_sets)))
+
+    return endpoint_sets
+
+# A function to bring the cached endpoint sets of an instance up to date from the 'changes' web method.
+# Returns None when the changes don't fit the cache.
+def fetchEndpointChanges(feed_cache, cached, instance, clientRequestId):
+
+    # URL needed for the changes since the cached version
+    webServiceChangesURL = baseURL() + "/changes/%s/%s?clientrequestid=" % (instance.lower(), cached['version'])
+
+    # do GET request
+    try:
+        req = feed_cache.session.get(webServiceChangesURL + clientRequestId)
+    except requests.RequestException as err:
+        sys.stdout.write("Failed to fetch the Web Service changes (%s), pulling the full feed.\n" % err)
+        return None
+
+    if(req.status_code != 200):
+        sys.stdout.write("Failed to fetch the Web Service changes - HTTP Return Code: %d, pulling the full feed.\n" % req.status_code)
+        return None
+
+    try:
+        changes = req.json()
+
+        # applyChanges works in place, on a copy the cache stays intact if the changes don't fit
+        endpoint_sets = applyChanges(copy.deepcopy(cached['endpointSets']), changes)
+    except (ValueError, KeyError, TypeError) as err:
+        sys.stdout.write("Web Service changes don't match the endpoint cache (%s), pulling the full feed.\n" % err)
+        return None
+
+    # user feedback
+    sys.stdout.write("Applied %d change records to the endpoint cache (%d bytes downloaded).\n" % (len(changes), len(req.content)))
+
+    return endpoint_sets
+
+# A function to get the endpoint sets of the latest version of an instance, from the cache, the changes or the full feed.
+# Returns None if the instance couldn't be fetched.
+def syncInstance(feed_cache, endpoint_cache, instance, newVersion, clientRequestId):
+
+    cached = endpoint_cache.get(instance)
+    endpoint_sets = None
+
+    # An earlier run or target already fetched this version
+    if cached is not None and cached['version'] == newVersion:
+        sys.stdout.write("Reusing the cached endpoint sets of version %s.\n" % newVersion)
+        return cached['endpointSets']
+
+    # Apply just the changes since the version we loaded last, if we still have it cached
+    if cached is None:
+        sys.stdout.write("No endpoint cache for the %s instance, pulling the full feed.\n" % instance)
+    elif CONFIG_DATA.get('DELTA_SYNC', True):
+        endpoint_sets = fetchEndpointChanges(feed_cache, cached, instance, clientRequestId)
+
+    # Fall back to the full feed
+    if endpoint_sets is None:
+        endpoint_sets = fetchEndpointSets(feed_cache, instance, clientRequestId)
+
+    if endpoint_sets is None:
+        return None
+
+    endpoint_cache[instance] = {'version': newVersion, 'endpointSets': endpoint_sets}
+    saveEndpointCache(endpoint_cache)
+
+    return endpoint_sets
 
 # A function to deploy pending policy pushes
-def DeployPolicies(fmc):
+def DeployPolicies(fmc, requested=None):
 
-    # Get pending deployments
-    pending_deployments = fmc.getPendingDeployments()
+    # All eligible devices go into one deployment request, which we can then follow to the devices
+    tracker = DeploymentTracker(fmc, CONFIG_DATA.get('DEPLOY_TIMEOUT', 1800))
 
-    # Setup a dict to hold our deployments
-    deployments = {}
+    device_count = tracker.deploy()
 
-    # See if there are pending deployments
-    if pending_deployments['paging']['count'] > 0:
+    # Tell the caller once the deployment request went through, before we wait for the devices
+    if requested is not None:
+        requested(device_count)
 
-        # Iterate through pending deployments
-        for item in pending_deployments['items']:
+    # See if there were pending deployments
+    if device_count == 0:
+        return
 
-            # Only get ones that can be deployed
-            if item['canBeDeployed']:
+    sys.stdout.write("All pending deployments have been requested.\n")
 
-                # Only get ones that don't cause traffic interruption
-                if item['trafficInterruption'] == "NO":
+    # Optionally wait for the devices, to see how long a feed change takes to be enforced
+    if CONFIG_DATA.get('DEPLOY_WAIT', True):
+        tracker.wait()
 
-                    # If there are multiple devices, append them
-                    if item['version'] in deployments:
-                        device_list = deployments[item['version']]
-                        device_list.append(item['device']['id'])
-                        deployments[item['version']] = device_list
-                    else:
-                        deployments[item['version']] = [item['device']['id']]
+        # user feedback
+        sys.stdout.write("\n")
+        sys.stdout.write(tracker.report() + "\n")
 
-        # Build JSON for each of our deployments
-        for version, devices in deployments.items():
+# A function to replace the literals of a group object, only when the effective set changed
+def updateGroupLiterals(fmc, object_endpoint, object_uuid, group_object, literals, key, normalize=None):
 
-            deployment_json = {
-                "type": "DeploymentRequest",
-                "version": version,
-                "forceDeploy": False,
-                "ignoreWarning": True,
-                "deviceList": devices,
-            }
+    # Shards nested in the group by a run with SHARD_SIZE set, they go now the literals are back in the group
+    shard_objects = [child for child in group_object.get('objects', []) if isShardObject(child, group_object)]
+    other_objects = [child for child in group_object.get('objects', []) if not isShardObject(child, group_object)]
+
+    # Compare what the FMC holds with what we want to push
+    added, removed = diffLiterals(group_object.get('literals', []), literals, key, normalize)
 
-            fmc.postDeployments(deployment_json)
+    # Skip the PUT, so the FMC doesn't mark the group as changed
+    if not added and not removed and not shard_objects:
+        sys.stdout.write("The %s object already holds these %d literals, no update needed.\n" % (object_endpoint, len(literals)))
+        return False
+
+    # FMC doesn't allow empty groups, leave the group as it is
+    if not literals and not other_objects:
+        sys.stdout.write("No literals for the %s object, FMC doesn't allow an empty group so it is left as it is.\n" % object_endpoint)
+        return False
+
+    # user feedback
+    sys.stdout.write("Updating the %s object: %d literals added, %d literals removed, %d shards removed.\n" % (object_endpoint, len(added), len(removed), len(shard_objects)))
 
-        sys.stdout.write("All pending deployments have been requested.\n")
-    
+    # Replace the 'literals' of the fetched group object, and drop the shards from its 'objects'
+    group_object['literals'] = literals
+    group_object.pop('links', None)
+
+    if other_objects:
+        group_object['objects'] = other_objects
     else:
+        group_object.pop('objects', None)
+
+    # Update the group object
+    fmc.updateObject(object_endpoint, object_uuid, group_object, exit_on_error=False)
+
+    # The shards can only go once the group no longer holds them
+    for shard_object in shard_objects:
+        fmc.deleteObject(object_endpoint, shard_object['id'], exit_on_error=False)
+
+    return True
+
+# A child group updateShardedGroup nested in the parent group, named <parent name>_<number>
+def isShardObject(child, parent_object):
+
+    shard_prefix = parent_object['name'] + '_'
+    name = child.get('name', '')
+
+    return child.get('type') == parent_object['type'] and name.startswith(shard_prefix) and name[len(shard_prefix):].isdigit()
+
+# A function to spread the literals over child groups of at most SHARD_SIZE literals, nested under the parent group.
+# Shards keep their literals across runs, so only the shards whose contents changed are rewritten.
+def updateShardedGroup(fmc, object_endpoint, parent_uuid, parent_object, literals, key, normalize=None):
+
+    if normalize is None:
+        normalize = lambda value: value
+
+    group_type = parent_object['type']
+    shard_prefix = parent_object['name'] + '_'
+    shard_size = CONFIG_DATA['SHARD_SIZE']
+
+    # Index the literals we want by their normalised value
+    wanted = {}
+    for literal in literals:
+        wanted.setdefault(normalize(literal[key]), literal)
+
+    # The shards are the child groups named after the parent, anything else nested in the parent is left alone
+    other_objects = []
+    shard_objects = []
+
+    for child in parent_object.get('objects', []):
+        if isShardObject(child, parent_object):
+            shard_objects.append(child)
+        else:
+            other_objects.append(child)
+
+    # FMC doesn't allow empty groups, so without literals the shards can only go if the parent holds something else
+    if not wanted and not other_objects:
+        sys.stdout.write("No literals for the %s object, FMC doesn't allow an empty group so it is left as it is.\n" % object_endpoint)
+        return False
+
+    shard_objects = [fmc.getObject(object_endpoint, child['id'], exit_on_error=False) for child in shard_objects]
+
+    shard_objects.sort(key=lambda shard_object: (len(shard_object['name']), shard_object['name']))
+    shard_names = set(shard_object['name'] for shard_object in shard_objects)
+
+    current_shards = []
+    for shard_object in shard_objects:
+        current_shards.append([normalize(literal[key]) for literal in shard_object.get('literals', []) if key in literal])
+
+    # Keep the literals in the shard they are in, fill in the new ones
+    shards = assignShards(current_shards, list(wanted), shard_size)
+
+    live_shards = []
+    empty_shards = []
+    updated = 0
+    created = 0
+
+    for index, values in enumerate(shards):
+
+        shard_literals = [wanted[value] for value in values]
+
+        # A new shard, pick the first free name
+        if index >= len(shard_objects):
+
+            number = 1
+            while shard_prefix + str(number) in shard_names:
+                number += 1
+
+            shard_names.add(shard_prefix + str(number))
+
+            object_json = {
+                'name': shard_prefix + str(number),
+                'type': group_type,
+                'overridable': True,
+                'literals': shard_literals,
+            }
+
+            live_shards.append(fmc.createObject(object_endpoint, object_json, exit_on_error=False))
+            created += 1
+            continue
+
+        shard_object = shard_objects[index]
+
+        # FMC doesn't allow empty groups, so the shard goes once it's out of the parent
+        if not values:
+            empty_shards.append(shard_object)
+            continue
+
+        # Only rewrite the shards whose contents changed
+        if set(values) != set(current_shards[index]):
+            shard_object['literals'] = shard_literals
+            shard_object.pop('links', None)
+            fmc.updateObject(object_endpoint, shard_object['id'], shard_object, exit_on_error=False)
+            updated += 1
+
+        live_shards.append(shard_object)
+
+    # Nest the shards under the parent, in place of any literals it held before sharding
+    parent_children = other_objects + [{'type': group_type, 'id': shard_object['id']} for shard_object in live_shards]
+    parent_changed = parent_object.get('literals') or set(child['id'] for child in parent_children) != set(child['id'] for child in parent_object.get('objects', []))
+
+    if parent_changed:
+        parent_object['objects'] = parent_children
+        parent_object.pop('literals', None)
+        parent_object.pop('links', None)
+        fmc.updateObject(object_endpoint, parent_uuid, parent_object, exit_on_error=False)
+
+    for shard_object in empty_shards:
+        fmc.deleteObject(object_endpoint, shard_object['id'], exit_on_error=False)
+
+    # user feedback
+    sys.stdout.write("The %s object holds %d literals in %d shards: %d shards rewritten, %d created, %d removed.\n" % (object_endpoint, len(wanted), len(live_shards), updated, created, len(empty_shards)))
 
-        sys.stdout.write("There were zero pending deployments.\n")
+    return bool(parent_changed or updated or created or empty_shards)
 
-# Function that can be used to schedule the O365WebServiceParser to refresh at intervals. Caution: this creates an infinite loop.
+# A function to update a group object with the given literals, sharded if SHARD_SIZE is set
+def updateGroup(fmc, object_endpoint, object_uuid, group_object, literals, key, normalize=None):
+
+    if CONFIG_DATA.get('SHARD_SIZE', 0):
+        return updateShardedGroup(fmc, object_endpoint, object_uuid, group_object, literals, key, normalize)
+
+    return updateGroupLiterals(fmc, object_endpoint, object_uuid, group_object, literals, key, normalize)
+
+# A function to get a group object of a target, creating it (and storing its UUID) if there is none yet
+def getGroupObject(fmc, target, uuid_key, object_endpoint, group_type, name):
+
+    # Get the group object of the specified UUID
+    if target[uuid_key] != '':
+        return fmc.getObject(object_endpoint, target[uuid_key], exit_on_error=False)
+
+    # Create the JSON to submit
+    object_json = {
+        'name': OBJECT_PREFIX + name,
+        'type': group_type,
+        'overridable': True,
+    }
+
+    # Create the group object in the FMC
+    group_object = fmc.createObject(object_endpoint, object_json, exit_on_error=False)
+
+    # Save the UUID of the object
+    target[uuid_key] = group_object['id']
+    saveConfig()
+
+    return group_object
+
+# A function to fill the group objects of a target from the endpoint sets of its instance. Returns True if they changed
+def updateTarget(fmc, target, endpoint_sets):
+
+    family = target.get('FAMILY', DEFAULT_FAMILY)
+    service_areas = target.get('SERVICE_AREAS', [])
+    categories = target.get('CATEGORIES', [])
+
+    # user feedback
+    sys.stdout.write("\n")
+    sys.stdout.write("Updating target %s (%s instance, %s addresses, %s, %s).\n" % (target['NAME'], target['INSTANCE'], family,
+        ', '.join(service_areas) or 'all service areas', ', '.join(categories) or 'all categories'))
+
+    # initiate order preserving, de-duplicating lists to be filled with addresses
+    URL_List = UniqueList()
+    IP_List = UniqueList()
+
+    selected = 0
+
+    # iterate through the endpoint sets of the target's service areas and categories, in feed order
+    for endpoint_set in selectEndpointSets(endpoint_sets, service_areas, categories):
+
+        selected += 1
+
+        # iterate through all URLs in each endpoint set
+        for url in endpoint_set['urls']:
+
+            # remove asterisks to put URLs into Firepower format 
+            #   (https://www.cisco.com/c/en/us/support/docs/security/firesight-management-center/118852-technote-firesight-00.html#anc14)
+            url = url.replace('*','')
+
+            # append the URL, duplicates are dropped
+            URL_List.add(url)
+
+        # iterate through the IPs of the target's address family in each endpoint set
+        for ip in filterFamily(endpoint_set['ips'], family):
+
+            # append the IP, duplicates are dropped
+            IP_List.add(ip)
+
+    # user feedback
+    sys.stdout.write("%d of %d endpoint sets selected: %d IPs, %d URLs.\n" % (selected, len(endpoint_sets), len(IP_List), len(URL_List)))
+
+    # The IP and URL groups are independent, so update them side by side over the shared FMC session.
+    # The workers raise FirepowerError rather than exit, so a failure is handled here, once both are done
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ip_future = executor.submit(updateIpGroup, fmc, target, IP_List)
+        url_future = executor.submit(updateUrlGroup, fmc, target, URL_List)
+
+    ip_changed = ip_future.result()
+    url_changed = url_future.result()
+
+    return ip_changed or url_changed
+
+# A function to update the NetworkGroup object of a target with the IPs, creating it if there is none yet
+def updateIpGroup(fmc, target, IP_List):
+
+    ip_group_object = getGroupObject(fmc, target, 'IP_UUID', 'networkgroups', 'NetworkGroup', target['NAME'] + '_IPs')
+
+    # optionally supernet the IPs, so the group holds as few literals as possible
+    if CONFIG_DATA.get('AGGREGATE_IPS', False):
+
+        literal_count = len(IP_List)
+        IP_List = aggregateNetworks(IP_List)
+
+        # user feedback
+        sys.stdout.write("IP literals aggregated from %d to %d.\n" % (literal_count, len(IP_List)))
+
+    # Build the 'literals' of the Network Group object from all the fetched IPs
+    ip_literals = [{'type': 'Network', 'value': ip_address} for ip_address in IP_List]
+
+    # Update the NetworkGroup object, if its literals changed
+    return updateGroup(fmc, 'networkgroups', target['IP_UUID'], ip_group_object, ip_literals, 'value', normalizeIp)
+
+# A function to update the UrlGroup object of a target with the URLs, creating it if there is none yet
+def updateUrlGroup(fmc, target, URL_List):
+
+    url_group_object = getGroupObject(fmc, target, 'URL_UUID', 'urlgroups', 'UrlGroup', target['NAME'] + '_URLs')
+
+    # Build the 'literals' of the URL Group object from all the fetched URLs
+    url_literals = [{'type': 'Url', 'url': url} for url in URL_List]
+
+    # Update the UrlGroup object, if its literals changed
+    return updateGroup(fmc, 'urlgroups', target['URL_UUID'], url_group_object, url_literals, 'url')
+
+# A function to post a message to the Webex room in the background, so it doesn't hold up the deployment.
+# Returns the thread sending it, None if Webex Teams isn't set
+def startWebexMessage(message_text):
+
+    # if Webex Teams tokens set, then send message to Webex room
+    if CONFIG_DATA['WEBEX_ACCESS_TOKEN'] == '' or CONFIG_DATA['WEBEX_ROOM_ID'] == '':
+
+        # user feed back
+        sys.stdout.write("Webex Teams not set.\n")
+        sys.stdout.write("\n")
+        return None
+
+    webex_thread = threading.Thread(target=sendWebexMessage, args=(message_text,))
+    webex_thread.start()
+
+    return webex_thread
+
+# A function to post a message to the Webex room
+def sendWebexMessage(message_text):
+
+    try:
+        # instantiate the Webex handler with the access token
+        webex = ciscosparkapi.CiscoSparkAPI(CONFIG_DATA['WEBEX_ACCESS_TOKEN'])
+
+        # post a message to the specified Webex room
+        webex.messages.create(CONFIG_DATA['WEBEX_ROOM_ID'], text=message_text)
+
+    except Exception as err:
+        sys.stdout.write("Failed to send the Webex Teams message: %s\n" % err)
+
+# Function that can be used to schedule the O365WebServiceParser# Function that can be used to schedule the O365WebServiceParser to refresh at intervals. Caution: this creates an infinite loop.
 # Takes the O365WebServiceParser function and the interval as parameters. 
 def intervalScheduler(function, interval):
 
@@ -164,195 +637,158 @@ def intervalScheduler(function, interval):
 # function to parse the Web Service, so that it can be called iteratively (e.g by the scheduler function)
 def WebServiceParser():
 
-    # Instantiate a Firepower object
+    # Instantiate a Firepower object, shared by all targets
     fmc = Firepower(CONFIG_DATA)
 
-    # If there's no defined Network Object, make one, then store the UUID - else, get the current object
-    if CONFIG_DATA['IP_UUID'] is '':
-
-        # Create the JSON to submit
-        object_json = {
-            'name': OBJECT_PREFIX + 'O365_Web_Service_IPs',
-            'type': 'NetworkGroup',
-            'overridable': True,
-        }
-
-        # Create the Network Group object in the FMC
-        ip_group_object = fmc.createObject('networkgroups', object_json)
-
-        # Save the UUID of the object
-        CONFIG_DATA['IP_UUID'] = ip_group_object['id']
-        saveConfig()
-    else:
-        # Get the Network Group object of the specified UUID
-        ip_group_object = fmc.getObject('networkgroups', CONFIG_DATA['IP_UUID'])
-
-    # If there's no defined URL Object, make one, then store the UUID
-    if CONFIG_DATA['URL_UUID'] is '':
-
-        # Create the JSON to submit
-        object_json = {
-            'name': OBJECT_PREFIX + 'O365_Web_Service_URLs',
-            'type': 'UrlGroup',
-            'overridable': True,
-        }
-
-        # Create the URL Group object in the FMC
-        url_group_object = fmc.createObject('urlgroups', object_json)
-
-        # Save the UUID of the object
-        CONFIG_DATA['URL_UUID'] = url_group_object['id']
-        saveConfig()
-    else:
-        # Get the URL Group object of the specified UUID
-        url_group_object = fmc.getObject('urlgroups', CONFIG_DATA['URL_UUID'])
-
-    # Get the latest version of the loaded feed
-    latestVersion = CONFIG_DATA['VERSION']
-
     # create GUID for GET requests
     clientRequestId = str(uuid.uuid4())
 
+    # Web service responses are cached on disk and revalidated, so an unchanged feed costs a 304
+    feed_cache = FeedCache(cacheDir())
+
     # URL needed to check latest version
-    webServiceVersionURL = "https://endpoints.office.com/version?clientrequestid="
+    webServiceVersionURL = baseURL() + "/version?clientrequestid="
 
     # assemble URL for get request for version 
     getURLVersion = webServiceVersionURL + clientRequestId
 
-    # do GET request 
-    reqVersion = requests.get(getURLVersion)
+    # do a conditional GET request 
+    version_path = feed_cache.get('version.json', getURLVersion)
+
+    if version_path is None:
+        fmc.close()
+        return
 
     # grab output in JSON format
-    version = reqVersion.json()
+    with open(version_path, 'r') as version_file:
+        version = json.loads(version_file.read())
 
-    # loop through version list and grab Wordwide list version
+    # loop through version list and grab the version of every instance
+    latestVersions = {}
     for element in version:
-        if(element['instance'] == 'Worldwide'):
-            newVersion = int(element['latest'])
-
-    # if the version did not change, the Web Service feed was not updated. 
-    if(newVersion == latestVersion):
+        latestVersions[element['instance']] = int(element['latest'])
 
-        # user feed back
-        sys.stdout.write("\n")
-        sys.stdout.write("Web Service List has NOT been updated since the last load, no update needed!\n") 
-        sys.stdout.write("\n")
+    endpoint_cache = loadEndpointCache()
 
-    # check if there is a newer version 
-    if(newVersion > latestVersion):
-
-        # update version and save the config
-        CONFIG_DATA['VERSION'] = newVersion
-
-        # user feedback
-        sys.stdout.write("\n")
-        sys.stdout.write("New version of Office 365 worldwide commercial service instance endpoints detected: %(version)s" % {'version': CONFIG_DATA['VERSION']})
-        sys.stdout.write("\n")
+    new_version = False
+    updated = False
+    webex_thread = None
 
-        ### PARSE JSON FEED ###
+    # instances whose feed could not be fetched and targets whose objects could not be updated
+    failed_instances = []
+    failed_targets = []
 
-        # URL needed for the worldwide web service feed
-        webServiceURL = "https://endpoints.office.com/endpoints/worldwide?clientrequestid="
+    # Each instance is fetched once, for all of its targets
+    for instance in UniqueList(target['INSTANCE'] for target in CONFIG_DATA['TARGETS']):
 
-        # assemble URL for get request
-        getURL = webServiceURL + clientRequestId
+        if instance not in latestVersions:
+            sys.stdout.write("\n")
+            sys.stdout.write("Unknown Office 365 instance %s, skipping its targets.\n" % instance)
+            continue
 
-        # do GET request 
-        req = requests.get(getURL)  
+        newVersion = latestVersions[instance]
 
-        # initiate lists to be filled with addresses
-        URL_List = []
-        IP_List = []
+        # The targets whose objects are older than the feed
+        targets = [target for target in CONFIG_DATA['TARGETS'] if target['INSTANCE'] == instance and target['VERSION'] < newVersion]
 
-        # error handling if true then the request was HTTP 200, so successful 
-        if(req.status_code == 200):
+        # if the version did not change, the Web Service feed was not updated. 
+        if not targets:
 
-            # grab output in JSON format
-            output = req.json()
+            # user feed back
+            sys.stdout.write("\n")
+            sys.stdout.write("Web Service List of the %s instance has NOT been updated since the last load, no update needed!\n" % instance)
+            sys.stdout.write("\n")
+            continue
 
-            # iterate through each 'item' in the JSON data
-            for item in output:
+        new_version = True
 
-                # make sure URLs exist in the item
-                if 'urls' in item:
-                    
-                    # iterate through all URLs in each item
-                    for url in item['urls']:
+        # user feedback
+        sys.stdout.write("\n")
+        sys.stdout.write("New version of Office 365 %(instance)s service instance endpoints detected: %(version)s" % {'instance': instance, 'version': newVersion})
+        sys.stdout.write("\n")
 
-                        # remove asterisks to put URLs into Firepower format 
-                        #   (https://www.cisco.com/c/en/us/support/docs/security/firesight-management-center/118852-technote-firesight-00.html#anc14)
-                        url = url.replace('*','')
+        endpoint_sets = syncInstance(feed_cache, endpoint_cache, instance, newVersion, clientRequestId)
 
-                        # if the URL hasn't already been appended, then append it
-                        if url not in URL_List:
-                            URL_List.append(url)
+        # Leave the versions alone, so the next run tries again
+        if endpoint_sets is None:
+            failed_instances.append(instance)
+            continue
 
-                # make sure IPs exist in the item
-                if 'ips' in item:
+        for target in targets:
 
-                    # iterate through all IPs in each item
-                    for ip in item['ips']:
+            try:
+                if updateTarget(fmc, target, endpoint_sets):
+                    updated = True
+            except FirepowerError as err:
 
-                        # if the IP hasn't already been appended, then append it
-                        if ip not in IP_List:
-                            IP_List.append(ip)
+                # Leave the version alone, so the next run tries the target again
+                sys.stdout.write("Failed to update target %s: %s\n" % (target['NAME'], err))
+                failed_targets.append(target['NAME'])
+                continue
 
-        # Reset the fetched Network Group object to clear the 'literals'
-        ip_group_object['literals'] = []
-        ip_group_object.pop('links', None)
+            # update version and save the config
+            target['VERSION'] = newVersion
+            saveConfig()
 
-        # Add all the fetched IPs to the 'literals'of the Network Group object
-        for ip_address in IP_List:
-            ip_group_object['literals'].append({'type': 'Network', 'value': ip_address})
+    # whatever failed keeps its old version, so the next run tries it again
+    if failed_instances or failed_targets:
 
-        # Update the NetworkGroup object
-        fmc.updateObject('networkgroups', CONFIG_DATA['IP_UUID'], ip_group_object)
+        # user feed back
+        sys.stdout.write("\n")
+        if failed_instances:
+            sys.stdout.write("Failed to fetch the Web Service List of %d instance(s): %s\n" % (len(failed_instances), ", ".join(failed_instances)))
+        if failed_targets:
+            sys.stdout.write("Failed to update %d target(s): %s\n" % (len(failed_targets), ", ".join(failed_targets)))
+        sys.stdout.write("They will be retried on the next run.\n")
+        sys.stdout.write("\n")
 
-        # Reset the fetched URL Group object to clear the 'literals'
-        url_group_object['literals'] = []
-        url_group_object.pop('links', None)
+    # if no object changed, there's nothing to deploy or announce
+    if new_version and not updated and not (failed_instances or failed_targets):
 
-        # Add all the fetched URLs to the 'literals' of the URL Group object
-        for url in URL_List:
-            url_group_object['literals'].append({'type': 'Url', 'url': url})
+        # user feed back
+        sys.stdout.write("\n")
+        sys.stdout.write("Web Service List changed, but the FMC objects already match it. No deployment needed.\n")
+        sys.stdout.write("\n")
 
-        # Update the UrlGroup object
-        fmc.updateObject('urlgroups', CONFIG_DATA['URL_UUID'], url_group_object)
+    elif updated:
 
         # user feed back
         sys.stdout.write("\n")
         sys.stdout.write("Web Service List has been successfully updated!\n")
         sys.stdout.write("\n")
 
-        saveConfig()
-
         # If the user wants us to deploy policies, then do it
         if CONFIG_DATA['AUTO_DEPLOY']:
-            DeployPolicies(fmc)
-        
-        # if Webex Teams tokens set, then send message to Webex room
-        if CONFIG_DATA['WEBEX_ACCESS_TOKEN'] is '' or CONFIG_DATA['WEBEX_ROOM_ID'] is '':
 
-            # user feed back
-            sys.stdout.write("Webex Teams not set.\n")
-            sys.stdout.write("\n")
+            webex_threads = []
+
+            # announce the deployment once it has been requested, the message goes out while we wait for the devices
+            def deploymentRequested(device_count):
+                if device_count:
+                    message_text = "Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment was initiated..."
+                else:
+                    message_text = "Microsoft Office 365 objects have been successfully updated!  No Firepower devices were pending deployment."
+                webex_threads.append(startWebexMessage(message_text))
+
+            DeployPolicies(fmc, deploymentRequested)
+
+            webex_thread = webex_threads[0] if webex_threads else None
         else:
+            webex_thread = startWebexMessage("Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment is required.")
 
-            # adjust the Webex message based on the config
-            if CONFIG_DATA['AUTO_DEPLOY']:
-                message_text = "Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment was initiated..."
-            else:
-                message_text = "Microsoft Office 365 objects have been successfully updated!  Firepower policy deployment is required."
+    # Let the Webex message go out before we report
+    if webex_thread is not None:
+        webex_thread.join()
 
-            # instantiate the Webex handler with the access token
-            webex = ciscosparkapi.CiscoSparkAPI(CONFIG_DATA['WEBEX_ACCESS_TOKEN'])
+    # user feedback
+    sys.stdout.write(feed_cache.report() + "\n")
 
-            # post a message to the specified Webex room
-            message = webex.messages.create(CONFIG_DATA['WEBEX_ROOM_ID'], text=message_text)
+    # Release the FMC connections and report how many of them were reused
+    fmc.close()
 
 ##############END PARSE FUNCTION##############START EXECUTION SCRIPT##############
 
-if __name__ == "__main__":
+def main():
 
     # Load config data from file
     loadConfig()
@@ -384,4 +820,7 @@ if __name__ == "__main__":
         sys.stdout.flush()
         pass
 
+if __name__ == "__main__":
+    main()
+
 # end of script
@@ -0,0 +1,129 @@
+#
+# Token bucket rate limiter for the FMC REST API (120 requests per minute per user)
+#
+
+# Import Libraries
+import asyncio
+import email.utils
+import threading
+import time
+
+# FMC allows 120 requests per minute per user
+FMC_REQUESTS_PER_MINUTE = 120
+
+# How long to back off on a 429 without a usable Retry-After header
+DEFAULT_RETRY_AFTER = 10.0
+
+# A thread safe token bucket, shared by every FMC call path of a process
+class RateLimiter:
+
+    # Limiters shared per FMC, see RateLimiter.shared()
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute=FMC_REQUESTS_PER_MINUTE, burst=10):
+
+        # The burst comes out of the per minute budget, so no 60 second window ever sees more
+        # than requests_per_minute requests: burst + rate * 60 == requests_per_minute
+        self.capacity   = min(float(burst), requests_per_minute / 2.0)
+        self.rate       = (requests_per_minute - self.capacity) / 60.0
+
+        self._tokens        = self.capacity
+        self._last          = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock          = threading.Lock()
+
+        # Statistics, so we can report how much the limit costs us
+        self.requests   = 0
+        self.delayed    = 0
+        self.throttled  = 0
+        self.total_wait = 0.0
+
+    # Get the limiter shared by everything talking to the given FMC
+    @classmethod
+    def shared(cls, key='default', requests_per_minute=FMC_REQUESTS_PER_MINUTE):
+
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(requests_per_minute)
+            return cls._shared[key]
+
+    # Claim the next request slot, returns how long the caller has to wait for it
+    def reserve(self):
+
+        with self._lock:
+            now = time.monotonic()
+
+            # Refill the bucket for the time that passed
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            # A negative bucket means the slot is in the future
+            self._tokens -= 1
+            delay = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+            # The FMC told us to back off
+            delay = max(delay, self._blocked_until - now)
+
+            self.requests += 1
+            if delay > 0:
+                self.delayed += 1
+                self.total_wait += delay
+
+            return delay
+
+    # Block until we're allowed to send the next request, returns the time waited
+    def acquire(self):
+
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+    # Same as acquire(), without blocking the event loop
+    async def acquireAsync(self):
+
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        return delay
+
+    # The FMC answered 429, hold every caller back for Retry-After seconds
+    def throttle(self, retry_after=None):
+
+        wait = self.parseRetryAfter(retry_after)
+
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            self._blocked_until = max(self._blocked_until, now + wait)
+
+            # Don't burst again straight after the back off
+            self._tokens = min(self._tokens, 0.0)
+
+        return wait
+
+    # Retry-After is either a number of seconds or an HTTP date
+    @staticmethod
+    def parseRetryAfter(retry_after):
+
+        if retry_after is None:
+            return DEFAULT_RETRY_AFTER
+
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+            return max(retry_date.timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+    def report(self):
+
+        return 'Rate limiter: {} requests, {} delayed, {} throttled by FMC (429), {:.1f} seconds waited in total.'.format(
+            self.requests, self.delayed, self.throttled, self.total_wait)
@@ -0,0 +1,234 @@
+#
+# FMC access token lifecycle: cross-process token cache with proactive refresh
+#
+
+# Import Libraries
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from requests.auth import HTTPBasicAuth
+
+# Platform specific file locking
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# FMC access tokens are valid for 30 minutes and can be refreshed 3 times
+TOKEN_LIFETIME  = 30 * 60
+REFRESH_MARGIN  = 5 * 60
+MAX_REFRESHES   = 3
+
+# Default location of the token cache, shared by all scripts of this user
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.fmc_token_cache.json')
+
+# A class to fetch, cache and refresh the FMC access token
+class TokenManager:
+
+    def __init__(self, fmc_ip, fmc_user, fmc_pass, session, cache_file=None):
+        self.fmc_ip     = fmc_ip
+        self.fmc_user   = fmc_user
+        self.fmc_pass   = fmc_pass
+        self.session    = session
+        self.cache_file = cache_file or DEFAULT_CACHE_FILE
+
+        # Tokens are cached per FMC and per user
+        self.cache_key  = '{}@{}'.format(fmc_user, fmc_ip)
+
+        self.token = None
+        self._lock = threading.Lock()
+
+    # Get a valid token, reusing the cached one and refreshing it before it expires
+    def getToken(self):
+
+        with self._lock:
+
+            # Our own copy is still good, no need to touch the cache file
+            if self.token and not self._isStale(self.token):
+                return self.token
+
+            with self._fileLock():
+
+                cached = self._readCache().get(self.cache_key)
+
+                # Another script may already have fetched or refreshed the token
+                if cached and not self._isStale(cached):
+                    print('Reusing cached FMC Authentication Token.')
+                    self.token = cached
+                    return self.token
+
+                self.token = self._renew(cached)
+                self._writeCache(self.token)
+
+            return self.token
+
+    # The FMC rejected the given token, so refresh it (or fetch a new one)
+    def invalidate(self, access_token):
+
+        with self._lock:
+            with self._fileLock():
+
+                cached = self._readCache().get(self.cache_key)
+
+                # Another script already replaced the rejected token
+                if cached and cached['access_token'] != access_token and not self._isExpired(cached):
+                    self.token = cached
+                    return self.token
+
+                if cached is None or cached['access_token'] != access_token:
+                    cached = self.token
+
+                self.token = self._renew(cached)
+                self._writeCache(self.token)
+
+            return self.token
+
+    # Refresh the given token if the FMC still allows it, else generate a new one
+    def _renew(self, token):
+
+        if token and token.get('refresh_token') and token['refresh_count'] < MAX_REFRESHES and not self._isExpired(token):
+            refreshed = self._refreshToken(token)
+            if refreshed:
+                return refreshed
+
+        return self._generateToken()
+
+    # Fetch a brand new token pair from the FMC
+    def _generateToken(self):
+
+        print('\nFetching Authentication Token from FMC...')
+
+        # Build URL for Authentication
+        auth_url = "https://{}/api/fmc_platform/v1/auth/generatetoken".format(self.fmc_ip)
+
+        try:
+            http_req = self.session.post(url=auth_url, auth=HTTPBasicAuth(self.fmc_user, self.fmc_pass), headers={'Content-Type': 'application/json'}, verify=self.session.verify)
+            http_req.close()
+
+            token = self._tokenFromHeaders(http_req.headers, 0)
+
+            # If we didn't get a token, then something went wrong
+            if token is None:
+                print('Authentication Token Not Found.  Exiting...')
+                exit()
+
+            print('Authentication Token Successfully Fetched.')
+
+            return token
+
+        except Exception as err:
+            print('Error fetching auth token from FMC: ' + str(err))
+            exit()
+
+    # Refresh the token pair using the refresh endpoint, returns None on failure
+    def _refreshToken(self, token):
+
+        print('\nRefreshing Authentication Token on FMC...')
+
+        # Build URL for the token refresh
+        refresh_url = "https://{}/api/fmc_platform/v1/auth/refreshtoken".format(self.fmc_ip)
+
+        # Build HTTP Headers with the current token pair
+        refresh_headers = {
+            'Content-Type': 'application/json',
+            'X-auth-access-token': token['access_token'],
+            'X-auth-refresh-token': token['refresh_token'],
+        }
+
+        try:
+            http_req = self.session.post(url=refresh_url, headers=refresh_headers, verify=self.session.verify)
+            http_req.close()
+
+            if http_req.status_code < 200 or http_req.status_code >= 300:
+                print('Token refresh failed - HTTP Return Code: {}'.format(http_req.status_code))
+                return None
+
+            refreshed = self._tokenFromHeaders(http_req.headers, token['refresh_count'] + 1)
+
+            # The domain is not always repeated on a refresh
+            if refreshed and not refreshed['domain_uuid']:
+                refreshed['domain_uuid'] = token['domain_uuid']
+
+            if refreshed:
+                print('Authentication Token Successfully Refreshed.')
+
+            return refreshed
+
+        except Exception as err:
+            print('Error refreshing auth token on FMC: ' + str(err))
+            return None
+
+    # Build a cache entry from the FMC auth response headers
+    def _tokenFromHeaders(self, headers, refresh_count):
+
+        access_token = headers.get('X-auth-access-token', None)
+
+        if access_token is None:
+            return None
+
+        return {
+            'access_token': access_token,
+            'refresh_token': headers.get('X-auth-refresh-token', None),
+            'domain_uuid': headers.get('DOMAIN_UUID', None),
+            'issued': time.time(),
+            'refresh_count': refresh_count,
+        }
+
+    # A token is stale shortly before it expires, so we refresh it proactively
+    def _isStale(self, token):
+        return time.time() >= token['issued'] + TOKEN_LIFETIME - REFRESH_MARGIN
+
+    def _isExpired(self, token):
+        return time.time() >= token['issued'] + TOKEN_LIFETIME
+
+    # Hold an exclusive lock on the cache, so scripts don't all fetch tokens at once
+    @contextmanager
+    def _fileLock(self):
+
+        with open(self.cache_file + '.lock', 'a+') as lock_file:
+
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            elif msvcrt:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                elif msvcrt:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _readCache(self):
+
+        if not os.path.isfile(self.cache_file):
+            return {}
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                return json.loads(cache_file.read())
+        except ValueError:
+            # A corrupt cache is just an empty one
+            return {}
+
+    # Write the cache atomically and readable only by the owner, it holds live tokens
+    def _writeCache(self, token):
+
+        cache_data = self._readCache()
+        cache_data[self.cache_key] = token
+
+        temp_file = self.cache_file + '.tmp'
+
+        with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as output_file:
+            json.dump(cache_data, output_file, indent=4)
+
+        os.replace(temp_file, self.cache_file)
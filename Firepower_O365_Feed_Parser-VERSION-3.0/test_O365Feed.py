@@ -0,0 +1,208 @@
+#
+# Tests for the O365 feed helpers, run with: python -m unittest test_O365Feed
+#
+
+# Import Libraries
+import functools
+import http.server
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import O365Feed
+
+# A request handler serving the files of a directory, without logging every request to stderr
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+class FeedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.served_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.served_dir)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        # A local stand-in for the web service, on a free port
+        handler = functools.partial(QuietHandler, directory=self.served_dir)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # FeedCache reports every fetch on stdout
+        patcher = mock.patch.object(O365Feed.sys, 'stdout', io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = O365Feed.FeedCache(self.cache_dir)
+        self.addCleanup(self.cache.session.close)
+
+    def serve(self, name, content):
+        with open(os.path.join(self.served_dir, name), 'w') as served_file:
+            served_file.write(content)
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], name)
+
+    def test_download_then_not_modified(self):
+
+        self.serve('version', '[{"instance": "Worldwide", "latest": "2024010100"}]')
+
+        path = self.cache.get('version.json', self.url('version'))
+        self.assertEqual(path, self.cache.path('version.json'))
+        with open(path) as cached_file:
+            self.assertEqual(json.load(cached_file)[0]['latest'], '2024010100')
+        self.assertEqual((self.cache.fetched, self.cache.not_modified), (1, 0))
+
+        # The Last-Modified validator is sent back, so the unchanged file costs a 304
+        self.assertEqual(self.cache.get('version.json', self.url('version')), path)
+        self.assertEqual((self.cache.fetched, self.cache.not_modified), (1, 1))
+        self.assertTrue(self.cache._loadValidators('version.json').get('last_modified'))
+
+    def test_discard_forces_a_download(self):
+
+        self.serve('version', '[]')
+        path = self.cache.get('version.json', self.url('version'))
+
+        self.cache.discard('version.json')
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.cache.path('version.json.meta')))
+
+        self.assertEqual(self.cache.get('version.json', self.url('version')), path)
+        self.assertEqual((self.cache.fetched, self.cache.not_modified), (2, 0))
+
+    def test_failed_request(self):
+
+        self.assertIsNone(self.cache.get('missing.json', self.url('missing')))
+        self.assertFalse(os.path.exists(self.cache.path('missing.json')))
+
+class IterJsonArrayTest(unittest.TestCase):
+
+    # Split the document into chunks of the given size, so elements and multibyte characters are cut in half
+    def chunks(self, document, size):
+        data = document.encode('utf-8')
+        return [data[pos:pos + size] for pos in range(0, len(data), size)]
+
+    def test_elements_split_over_chunks(self):
+
+        items = [{'id': 1, 'urls': ['*.office.com']}, {'id': 2, 'ips': ['13.107.6.152/31']}, {'id': 3, 'notes': 'Zürich'}]
+        document = ' [ ' + ', '.join(json.dumps(item, ensure_ascii=False) for item in items) + ' ]\n'
+
+        for size in [1, 2, 3, 7, 64, len(document)]:
+            self.assertEqual(list(O365Feed.iterJsonArray(self.chunks(document, size))), items)
+
+    def test_empty_array(self):
+        self.assertEqual(list(O365Feed.iterJsonArray(self.chunks('[]', 1))), [])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(O365Feed.iterJsonArray([b'{"id": 1}']))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(O365Feed.iterJsonArray(self.chunks('[{"id": 1}, {"id": 2', 4)))
+
+class ApplyChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint_sets = O365Feed.buildEndpointSets([
+            {'id': 1, 'serviceArea': 'Exchange', 'category': 'Optimize', 'required': True, 'ips': ['13.107.6.152/31'], 'urls': ['outlook.office.com']},
+            {'id': 2, 'serviceArea': 'Common', 'category': 'Allow', 'required': True, 'urls': ['*.msocdn.com']},
+        ])
+
+    def test_add_change_and_remove(self):
+
+        changes = [
+            {'id': 12, 'endpointSetId': 1, 'disposition': 'change', 'version': '2024010100',
+             'add': {'ips': ['40.96.0.0/13']}, 'remove': {'ips': ['13.107.6.152/31']}},
+            {'id': 13, 'endpointSetId': 3, 'disposition': 'add', 'version': '2024010100',
+             'current': {'serviceArea': 'Skype', 'category': 'Default', 'required': False}, 'add': {'urls': ['*.lync.com']}},
+            {'id': 11, 'endpointSetId': 2, 'disposition': 'remove', 'version': '2024010100'},
+        ]
+
+        O365Feed.applyChanges(self.endpoint_sets, changes)
+
+        self.assertEqual(sorted(self.endpoint_sets), ['1', '3'])
+        self.assertEqual(self.endpoint_sets['1']['ips'], ['40.96.0.0/13'])
+        self.assertEqual(self.endpoint_sets['1']['urls'], ['outlook.office.com'])
+        self.assertEqual(self.endpoint_sets['3'], {'ips': [], 'urls': ['*.lync.com'], 'serviceArea': 'Skype', 'category': 'Default', 'required': False})
+
+    def test_changes_replayed_in_order(self):
+
+        # Published as add then remove, listed the other way round
+        changes = [
+            {'id': 2, 'endpointSetId': 1, 'disposition': 'change', 'version': '2024020100', 'remove': {'urls': ['teams.office.com']}},
+            {'id': 1, 'endpointSetId': 1, 'disposition': 'change', 'version': '2024010100', 'add': {'urls': ['teams.office.com']}},
+        ]
+
+        O365Feed.applyChanges(self.endpoint_sets, changes)
+        self.assertEqual(self.endpoint_sets['1']['urls'], ['outlook.office.com'])
+
+    def test_unknown_endpoint_set(self):
+        with self.assertRaises(ValueError):
+            O365Feed.applyChanges(self.endpoint_sets, [{'id': 1, 'endpointSetId': 9, 'disposition': 'change'}])
+
+    def test_new_endpoint_set_without_service_area(self):
+        with self.assertRaises(ValueError):
+            O365Feed.applyChanges(self.endpoint_sets, [{'id': 1, 'endpointSetId': 9, 'disposition': 'add', 'add': {'urls': ['a.com']}}])
+
+    def test_not_a_list(self):
+        with self.assertRaises(ValueError):
+            O365Feed.applyChanges(self.endpoint_sets, {'error': 'Bad request'})
+
+class AssignShardsTest(unittest.TestCase):
+
+    def test_new_values_fill_new_shards(self):
+        self.assertEqual(O365Feed.assignShards([], ['a', 'b', 'c', 'd', 'e'], 2), [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_values_stay_in_their_shard(self):
+
+        shards = O365Feed.assignShards([['a', 'b'], ['c', 'd']], ['d', 'c', 'e', 'a'], 2)
+
+        # 'b' is gone, 'e' takes its place and the second shard is untouched
+        self.assertEqual(shards, [['a', 'e'], ['c', 'd']])
+
+    def test_emptied_shard_and_duplicates(self):
+
+        shards = O365Feed.assignShards([['a', 'b'], ['c']], ['a', 'a', 'b', 'b'], 2)
+        self.assertEqual(shards, [['a', 'b'], []])
+
+    def test_smaller_shard_size(self):
+
+        # Values over the new size move on to another shard
+        shards = O365Feed.assignShards([['a', 'b', 'c']], ['a', 'b', 'c'], 2)
+        self.assertEqual(shards, [['a', 'b'], ['c']])
+
+class DiffLiteralsTest(unittest.TestCase):
+
+    def test_added_and_removed(self):
+
+        current = [{'type': 'Network', 'value': '10.0.0.0/8'}, {'type': 'Host', 'value': '1.2.3.4'}]
+        desired = [{'type': 'Network', 'value': '10.0.0.0/8'}, {'type': 'Network', 'value': '192.168.0.0/16'}]
+
+        self.assertEqual(O365Feed.diffLiterals(current, desired, 'value'), (['192.168.0.0/16'], ['1.2.3.4']))
+
+    def test_host_and_prefix_compare_equal(self):
+
+        current = [{'type': 'Host', 'value': '1.2.3.4'}, {'type': 'Host', 'value': '2603:1006::1'}]
+        desired = [{'type': 'Network', 'value': '1.2.3.4/32'}, {'type': 'Network', 'value': '2603:1006::1/128'}]
+
+        self.assertEqual(O365Feed.diffLiterals(current, desired, 'value', O365Feed.normalizeIp), ([], []))
+
+    def test_literals_without_the_key_are_ignored(self):
+
+        current = [{'type': 'Url', 'url': 'a.com'}, {'type': 'Network', 'value': '10.0.0.0/8'}]
+        desired = [{'type': 'Url', 'url': 'a.com'}, {'type': 'Url', 'url': 'b.com'}]
+
+        self.assertEqual(O365Feed.diffLiterals(current, desired, 'url'), (['b.com'], []))
+
+if __name__ == '__main__':
+    unittest.main()
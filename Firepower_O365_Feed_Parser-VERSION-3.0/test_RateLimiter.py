@@ -0,0 +1,75 @@
+#
+# Tests for the FMC rate limiter, run with: python -m unittest test_RateLimiter
+#
+
+# Import Libraries
+import unittest
+from unittest import mock
+import RateLimiter
+
+# A clock we move by hand, instead of sleeping through minutes of real time
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.multiple(RateLimiter.time, monotonic=self.clock.monotonic, sleep=self.clock.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Send requests as fast as the limiter allows for the given seconds, returns the times they were granted
+    def grantTimes(self, limiter, seconds):
+
+        start = self.clock.now
+        grants = []
+
+        while True:
+            limiter.acquire()
+            if self.clock.now - start >= seconds:
+                return grants
+            grants.append(self.clock.now - start)
+
+    def test_first_minute_within_budget(self):
+
+        limiter = RateLimiter.RateLimiter(120, burst=10)
+
+        self.assertLessEqual(len(self.grantTimes(limiter, 60)), 120)
+
+    def test_every_minute_within_budget(self):
+
+        limiter = RateLimiter.RateLimiter(120, burst=10)
+
+        # Idle long enough for the bucket to fill up again half way through
+        grants = self.grantTimes(limiter, 30)
+        self.clock.now += 45
+        grants += [75 + grant for grant in self.grantTimes(limiter, 120)]
+
+        for start in grants:
+            in_window = [grant for grant in grants if start <= grant < start + 60]
+            self.assertLessEqual(len(in_window), 120)
+
+    def test_sustained_rate_uses_the_budget(self):
+
+        limiter = RateLimiter.RateLimiter(120, burst=10)
+
+        # Over a long run only the burst is held back from the budget: 10 + 110 per minute
+        self.assertGreaterEqual(len(self.grantTimes(limiter, 600)), 1100)
+
+    def test_small_budget(self):
+
+        limiter = RateLimiter.RateLimiter(4, burst=10)
+
+        self.assertLessEqual(len(self.grantTimes(limiter, 60)), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,67 +1,140 @@
 #
-# Generated FMC REST API sample script
+# Export the FMC object tables to NDJSON or CSV files, one file per object type
 #
- 
+
+import argparse
+import asyncio
+import csv
 import json
+import os
 import sys
-import requests
- 
+import time
+
+# Reuse the FMC client shipped with the O365 feed parser
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Firepower_O365_Feed_Parser-VERSION-3.0'))
+from AsyncFirepower import AsyncFirepower
+from Firepower import FirepowerError
+
 server = "https://10.56.140.9"
- 
+
 username = "api"
-if len(sys.argv) > 1:
-    username = sys.argv[1]
+
 password = "apiapiapi"
-if len(sys.argv) > 2:
-    password = sys.argv[2]
-               
-r = None
-headers = {'Content-Type': 'application/json'}
-api_auth_path = "/api/fmc_platform/v1/auth/generatetoken"
-auth_url = server + api_auth_path
-try:
-    # 2 ways of making a REST call are provided:
-    # One with "SSL verification turned off" and the other with "SSL verification turned on".
-    # The one with "SSL verification turned off" is commented out. If you like to use that then 
-    # uncomment the line where verify=False and comment the line with =verify='/path/to/ssl_certificate'
-    # REST call with SSL verification turned off: 
-    r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,password), verify=False)
-    # REST call with SSL verification turned on: Download SSL certificates from your FMC first and provide its path for verification.
-    # r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,password), verify='/path/to/ssl_certificate')
-    auth_headers = r.headers
-    auth_token = auth_headers.get('X-auth-access-token', default=None)
-    if auth_token == None:
-        print("auth_token not found. Exiting...")
-        sys.exit()
-except Exception as err:
-    print ("Error in generating auth token --> "+str(err))
-    sys.exit()
- 
-headers['X-auth-access-token']=auth_token
- 
-api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/networks?expanded=true&limit=200"    # param
-url = server + api_path
-if (url[-1] == '/'):
-    url = url[:-1]
- 
-# GET OPERATION
- 
-
-try:
-    # REST call with SSL verification turned off: 
-    r = requests.get(url, headers=headers, verify=False)
-    # REST call with SSL verification turned on:
-    # r = requests.get(url, headers=headers, verify='/path/to/ssl_certificate')
-    status_code = r.status_code
-    resp = r.text
-    if (status_code == 200):
-        print("GET successful. Response data --> ")
-        json_resp = json.loads(resp)
-        print(json.dumps(json_resp,sort_keys=True,indent=4, separators=(',', ': ')))
-    else:
-        r.raise_for_status()
-        print("Error occurred in GET --> "+resp)
-except requests.exceptions.HTTPError as err:
-    print ("Error in connection --> "+str(err)) 
-finally:
-    if r : r.close()
+
+# The object types we export, by object endpoint
+OBJECT_TYPES = ['networks', 'hosts', 'ranges', 'fqdns', 'networkgroups', 'protocolportobjects', 'portobjectgroups', 'urls', 'urlgroups', 'securityzones']
+
+# The FMC returns at most 1000 items per page
+PAGE_SIZE = 1000
+
+# Columns of the CSV export, every object type is flattened into them
+CSV_COLUMNS = ['id', 'name', 'type', 'value', 'members', 'description']
+
+
+# the value of an object as one string: an address, a URL, protocol/port, or a zone's interface mode
+def object_value(obj):
+    if 'value' in obj:
+        return obj['value']
+    if 'url' in obj:
+        return obj['url']
+    if 'protocol' in obj:
+        return obj['protocol'] + ('/' + obj['port'] if obj.get('port') else '')
+    return obj.get('interfaceMode', '')
+
+
+# the members of a group (objects by name, literals by value) or the interfaces of a zone, ; separated
+def object_members(obj):
+    members = [member.get('name', '') for member in obj.get('objects', []) + obj.get('interfaces', [])]
+    members += [object_value(literal) for literal in obj.get('literals', [])]
+    return ';'.join(members)
+
+
+def csv_row(obj):
+    return [obj.get('id', ''), obj.get('name', ''), obj.get('type', ''), object_value(obj), object_members(obj), obj.get('description', '')]
+
+
+# page through one object type, writing each page to the file as it arrives, so only one page is ever held in memory.
+# The file only replaces an earlier export once it is complete. Returns (object type, objects, seconds, error).
+async def export_type(fmc, object_type, output_dir, output_format):
+    path = os.path.join(output_dir, object_type + '.' + output_format)
+    temp_path = path + '.tmp'
+    count = 0
+    started = time.monotonic()
+
+    complete = False
+    try:
+        with open(temp_path, 'w', newline='') as output_file:
+            if output_format == 'csv':
+                writer = csv.writer(output_file)
+                writer.writerow(CSV_COLUMNS)
+            async for obj in fmc.getAllObjects(object_type, PAGE_SIZE):
+                if output_format == 'csv':
+                    writer.writerow(csv_row(obj))
+                else:
+                    output_file.write(json.dumps(obj, separators=(',', ':')) + '\n')
+                count += 1
+        os.replace(temp_path, path)
+        complete = True
+    except FirepowerError as err:
+        return object_type, count, time.monotonic() - started, str(err)
+    finally:
+        # whatever stopped the export, don't leave a partial file behind
+        if not complete and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return object_type, count, time.monotonic() - started, None
+
+
+# export the object types concurrently, at most max_in_flight requests at a time under the shared FMC rate limit
+async def export_all(config_data, object_types, output_dir, output_format, max_in_flight):
+    async with AsyncFirepower(config_data, max_in_flight) as fmc:
+        return await asyncio.gather(*[export_type(fmc, object_type, output_dir, output_format) for object_type in object_types])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the FMC object tables, one NDJSON or CSV file per object type")
+    parser.add_argument('username', nargs='?', default=username)
+    parser.add_argument('password', nargs='?', default=password)
+    parser.add_argument('--server', default=server, help="FMC IP address or name")
+    parser.add_argument('--types', nargs='+', default=OBJECT_TYPES, help="object types to export, all of them by default")
+    parser.add_argument('--format', dest='output_format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--output_dir', default='objects', help="directory the files are written to")
+    parser.add_argument('--max_in_flight', type=int, default=4, help="FMC requests in flight at the same time, the shared FMC rate limit still applies")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    config_data = {
+        'FMC_IP': args.server.split("://")[-1],
+        'FMC_USER': args.username,
+        'FMC_PASS': args.password,
+        'SSL_VERIFY': False,
+        'SSL_CERT': None,
+    }
+
+    started = time.monotonic()
+    total = 0
+    failed = []
+
+    # every object type shares the client, its connection pool, token and rate limiter
+    results = asyncio.run(export_all(config_data, args.types, args.output_dir, args.output_format, max(1, args.max_in_flight)))
+
+    for object_type, count, seconds, error in results:
+        if error:
+            print("Exporting {} failed after {} objects --> {}".format(object_type, count, error))
+            failed.append(object_type)
+            continue
+        total += count
+        print("Exported {} {} in {:.1f} seconds ({:.1f} objects/sec)".format(count, object_type, seconds, count / seconds if seconds else 0.0))
+
+    elapsed = time.monotonic() - started
+    print("Exported {} objects of {} types to {} in {:.1f} seconds, {:.1f} objects/sec".format(
+        total, len(args.types) - len(failed), args.output_dir, elapsed, total / elapsed if elapsed else 0.0))
+    if failed:
+        print("Failed object types: " + ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,160 +1,564 @@
+#
+# Import network objects from a CSV file (name, value, description) into the FMC
+#
 
+import argparse
+import csv
+import ipaddress
 import json
+import os
+import queue
 import sys
-import requests
-import csv
+import threading
 
-server = "svrname/or ip"
+# Reuse the FMC client shipped with the O365 feed parser
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Firepower_O365_Feed_Parser-VERSION-3.0'))
+from Firepower import Firepower, FirepowerError
 
+server = "svrname/or ip"
 
 username = "username"
 
-if len(sys.argv) > 1:
-
-    username = sys.argv[1]
-
 password = "password"
 
-if len(sys.argv) > 2:
-
-    password = sys.argv[2]
-
 filename = "filename"
 
-if len(sys.argv) > 3:
-
-    filename = sys.argv[2]
-
-
-
-# turn off SSL warnings
-
-requests.packages.urllib3.disable_warnings()
-
-
-
-
-
-# do authentication work               
-
-r = None
-
-headers = {'Content-Type': 'application/json'}
-
-api_auth_path = "/api/fmc_platform/v1/auth/generatetoken"
-
-auth_url = server + api_auth_path
-
-
-
-print("Trying to authenticate on "+server+" ...")
-
-try:
-
-    r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,password), verify=False)
-
-    auth_headers = r.headers
-
-    auth_token = auth_headers.get('X-auth-access-token', default=None)
-
-    if auth_token == None:
-
-        print("auth_token not found. Exiting...")
-
-        sys.exit()
-
-    print("Authentication successful... move on...")
-
-    print(".")
-
-    
-
-except Exception as err:
-
-    print ("Error in generating auth token --> "+str(err))
-
-    sys.exit()
-
- 
-
-headers['X-auth-access-token']=auth_token
-
- 
-
-
-
-
-
-
-
-# prepare input from file
-
-hostsfile = open(filename, 'r')
-
-reader = csv.reader(hostsfile)
-
-
-
-hostlist = []
-
-for line in reader:
-
- list_line= { 'name': str(line[0]),'type': 'Network','value': str(line[1]),'description': str(line[2]) }
-
- hostlist.append(list_line)
-
- 
-
-
-
-
-
-# POST OPERATION
-
- 
-
-print("Attempting to add Hosts from file "+filename+" ...")
-
-try:
-
-
-
-    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/networks"
-
-    url = server + api_path
-
-
-
-    for host in hostlist:
-
-       r = requests.post(url, headers=headers,data=json.dumps(host), verify=False)
-
-      
-
-       status_code = r.status_code
-
-       resp = r.text
-
-
-
-       if (status_code == 201):
-
-        print("Host "+host['name']+" with IP "+host['value']+" successfully added")
-
-        
-
-       else:
-
-        if (status_code == 400): 
-
-         print("Host seems to exist already - skipping...")
-
-
-
-except requests.exceptions.HTTPError as err:
-
-    print ("Error in connection --> "+str(err)) 
-
-finally:
-
-    if r : r.close()
+# The FMC accepts at most 1000 objects per bulk request
+MAX_BATCH_SIZE = 1000
+
+# Rows per chunk when the hosts are POSTed one by one
+SINGLE_CHUNK_SIZE = 100
+
+# Chunks the reader may parse ahead of the sender
+QUEUE_DEPTH = 4
+
+# How often a rejected bulk batch is halved before both halves failing again means the bad hosts are dense,
+# then they are POSTed one by one: splitting all the way down costs about 2N requests when every host fails
+MAX_SPLIT_DEPTH = 1
+
+# How the FMC words the rejection of a host whose name is taken
+DUPLICATE_NAME_MESSAGE = 'already exists'
+
+# The object endpoint of each object type, these are also where a CSV host can already exist
+ENDPOINTS = {'Host': 'hosts', 'Network': 'networks', 'Range': 'ranges'}
+
+
+# the object type and normalised value of an address: a host, a network or a range, IPv4 or IPv6
+def classify(value):
+    if '-' in value:
+        first, last = [ipaddress.ip_address(part.strip()) for part in value.split('-', 1)]
+        if first.version != last.version:
+            raise ValueError("range " + value + " mixes IPv4 and IPv6")
+        if first > last:
+            raise ValueError("range " + value + " ends before it starts")
+        return 'Range', '{}-{}'.format(first, last)
+    if '/' in value:
+        # strict, a network with host bits set is most likely a typo
+        network = ipaddress.ip_network(value)
+        if network.prefixlen == network.max_prefixlen:
+            return 'Host', str(network.network_address)
+        return 'Network', str(network)
+    return 'Host', str(ipaddress.ip_address(value))
+
+
+# read the file one row at a time, yielding (line number, host) for every valid row.
+# Fields are stripped, blank rows skipped, a first row that isn't an address is taken as the header,
+# and invalid rows are reported with their line number.
+def read_hosts(filename, stats, start_line=0):
+    with open(filename, 'r', newline='') as hostsfile:
+        reader = csv.reader(hostsfile, skipinitialspace=True)
+        first = True
+        for row in reader:
+            # rows a previous run already committed
+            if reader.line_num <= start_line:
+                first = False
+                continue
+
+            fields = [field.strip() for field in row]
+            if not any(fields):
+                continue
+
+            if len(fields) < 2 or not fields[0] or not fields[1]:
+                print("Line {}: expected name, value[, description] - skipping".format(reader.line_num))
+                stats['invalid'] += 1
+                first = False
+                continue
+
+            try:
+                object_type, value = classify(fields[1])
+            except ValueError as err:
+                if first:
+                    print("Line {}: skipping the header row".format(reader.line_num))
+                else:
+                    print("Line {}: {} is not a host, network or range ({}) - skipping".format(reader.line_num, fields[1], err))
+                    stats['invalid'] += 1
+                first = False
+                continue
+
+            first = False
+            stats['rows'] += 1
+            yield reader.line_num, {'name': fields[0], 'type': object_type, 'value': value, 'description': fields[2] if len(fields) > 2 else ''}
+
+
+# parse the rows in a background thread, handing chunks of them to the sender through a bounded queue,
+# so the file is read while the FMC works and only a few chunks are ever held in memory
+def read_chunks(rows, chunk_size):
+    chunks = queue.Queue(maxsize=QUEUE_DEPTH)
+
+    def produce():
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    chunks.put(chunk)
+                    chunk = []
+            if chunk:
+                chunks.put(chunk)
+            chunks.put(None)
+        except Exception as err:
+            chunks.put(err)
+
+    # a daemon, so a failed import doesn't wait on a reader blocked on the full queue
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+
+
+# A JSON lines journal of an import: a record of the objects each request created, written as soon as they exist,
+# and a checkpoint with the last line of every committed chunk.
+# A crashed import resumes after the last committed chunk, and the created objects double as a rollback list.
+class ImportJournal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.load()
+        self.journal_file = None
+
+    def load(self):
+        entries = []
+        if not os.path.isfile(self.path):
+            return entries
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a record cut short by a crash, its chunk never committed
+                    break
+        return entries
+
+    # the import ran to the end, there is nothing to resume
+    def finished(self):
+        return any(entry.get('done') for entry in self.entries)
+
+    # a rollback left objects behind, only another rollback may continue this journal
+    def rolling_back(self):
+        return any(entry.get('rollback') for entry in self.entries)
+
+    def last_line(self):
+        return max([entry.get('line', 0) for entry in self.entries] + [0])
+
+    def created(self):
+        return [tuple(obj) for entry in self.entries for obj in entry.get('created', [])]
+
+    # objects created after the last checkpoint, by the chunk a crash interrupted
+    def uncommitted(self):
+        created = []
+        for entry in self.entries:
+            if 'line' in entry:
+                created = []
+            created.extend(tuple(obj) for obj in entry.get('created', []))
+        return created
+
+    def source(self):
+        return next((entry for entry in self.entries if 'file' in entry), {})
+
+    # start a new journal for the file, replacing the previous one
+    def start(self, filename):
+        self.entries = []
+        self.rewrite([{'file': os.path.abspath(filename), 'size': os.path.getsize(filename), 'mtime': os.path.getmtime(filename)}])
+
+    # carry on with the journal, minus a record a crash may have cut short
+    def reopen(self):
+        self.rewrite(list(self.entries))
+
+    def rewrite(self, entries):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as journal_file:
+            for entry in entries:
+                journal_file.write(json.dumps(entry) + '\n')
+        os.replace(temp_path, self.path)
+        self.entries = entries
+        self.journal_file = open(self.path, 'a')
+
+    def append(self, entry):
+        self.journal_file.write(json.dumps(entry) + '\n')
+        # the record has to be on disk before the next chunk is sent
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.entries.append(entry)
+
+    def record(self, created):
+        self.append({'created': created})
+
+    def commit(self, line_num):
+        self.append({'line': line_num})
+
+    def finish(self):
+        self.append({'done': True})
+
+    def close(self):
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+# the reason the FMC gives for rejecting a request
+def error_description(err):
+    if isinstance(err.response, dict):
+        messages = err.response.get('error', {}).get('messages', [])
+        descriptions = [message.get('description', '') for message in messages]
+        if descriptions:
+            return '; '.join(descriptions)
+    return str(err.response)
+
+
+# page through the existing networks, hosts and ranges into a name -> object index
+def build_name_index(fmc):
+    index = {}
+    for endpoint in ENDPOINTS.values():
+        for obj in fmc.getAllObjects(endpoint):
+            index[obj['name']] = {
+                'endpoint': endpoint,
+                'id': obj['id'],
+                'type': obj['type'],
+                'value': obj.get('value', ''),
+                'description': obj.get('description', ''),
+            }
+        print("Indexed {} objects after {}".format(len(index), endpoint))
+    return index
+
+
+# the same address, however it is written (10.1.1.1 vs 10.1.1.1/32, IPv6 zero compression)
+def same_value(value, other):
+    try:
+        return classify(value.strip()) == classify(other.strip())
+    except ValueError:
+        return value.strip() == other.strip()
+
+
+class HostImporter(object):
+
+    def __init__(self, fmc, bulk=False, batch_size=MAX_BATCH_SIZE, index=None, journal=None):
+        self.fmc = fmc
+        # every object created is journaled straight away, so a crash can't lose track of it
+        self.journal = journal
+        self.bulk = bulk
+        self.batch_size = batch_size
+        # bulk batch size, adapted to how often the FMC rejects batches
+        self.size = batch_size
+        # names that exist already will keep failing, so after one the batches don't grow back
+        self.grow = True
+        # name index of the existing objects, for upserts
+        self.index = index
+        self.seen = set()
+        # names the interrupted run created in the chunk it was on, a resume doesn't create them twice
+        self.resumed = set()
+        self.stats = dict.fromkeys(['rows', 'invalid', 'created', 'updated', 'unchanged', 'failed', 'repeated'], 0)
+
+    def record(self, endpoint, objects):
+        if self.journal is not None and objects:
+            self.journal.record([(endpoint, obj['id'], obj['name']) for obj in objects])
+
+    def fail(self, line_num, host, reason):
+        print("Line {}: host {} with IP {} failed: {}".format(line_num, host['name'], host['value'], reason))
+        self.stats['failed'] += 1
+
+    # import one chunk of (line number, host) rows, returns the (endpoint, id, name) of the objects created
+    def import_chunk(self, chunk):
+        creates = {}
+        updates = []
+        for line_num, host in chunk:
+            if host['name'] in self.resumed:
+                print("Line {}: host {} was added before the import was interrupted - skipping".format(line_num, host['name']))
+                self.resumed.discard(host['name'])
+                continue
+
+            if self.index is None:
+                creates.setdefault(host['type'], []).append((line_num, host))
+                continue
+
+            # sort the hosts into creates for new names and updates for changed ones,
+            # identical hosts are skipped without any API call
+            if host['name'] in self.seen:
+                print("Line {}: host {} is in the file more than once - skipping the repeat".format(line_num, host['name']))
+                self.stats['repeated'] += 1
+                continue
+            self.seen.add(host['name'])
+
+            existing = self.index.get(host['name'])
+            if existing is None:
+                creates.setdefault(host['type'], []).append((line_num, host))
+            elif existing['type'] != host['type']:
+                self.fail(line_num, host, "exists as a " + existing['type'] + " with value " + existing['value'])
+            elif same_value(existing['value'], host['value']) and existing['description'].strip() == host['description'].strip():
+                self.stats['unchanged'] += 1
+            else:
+                updates.append((line_num, existing, host))
+
+        created = []
+        for object_type, rows in creates.items():
+            if self.bulk:
+                created.extend(self.create_bulk(ENDPOINTS[object_type], rows))
+            else:
+                created.extend(self.create_single(ENDPOINTS[object_type], rows))
+        for line_num, existing, host in updates:
+            self.update(line_num, existing, host)
+        return created
+
+    # one POST per host, a host that exists already is skipped
+    def create_single(self, endpoint, rows):
+        created_objects, failed = self.send_rows(endpoint, rows)
+        for line_num, host, reason in failed:
+            self.fail(line_num, host, reason)
+        created = [(endpoint, obj['id'], obj['name']) for obj in created_objects]
+        self.stats['created'] += len(created)
+        return created
+
+    # POST the hosts one at a time, returns the created objects and the (line number, host, reason) of every host that failed
+    def send_rows(self, endpoint, rows):
+        created = []
+        failed = []
+        for line_num, host in rows:
+            try:
+                obj = self.fmc.createObject(endpoint, host, exit_on_error=False)
+                self.record(endpoint, [obj])
+                created.append(obj)
+                print("Host " + host['name'] + " with IP " + host['value'] + " successfully added")
+            except FirepowerError as err:
+                if err.status_code is None:
+                    raise
+                if err.status_code == 400:
+                    print("Host seems to exist already - skipping...")
+                failed.append((line_num, host, error_description(err)))
+        return created, failed
+
+    # bulk POST the hosts in batches of up to the current batch size
+    def create_bulk(self, endpoint, rows):
+        created = []
+        position = 0
+        while position < len(rows):
+            batch = rows[position:position + self.size]
+            position += len(batch)
+
+            batch_created, batch_failed = self.send_batch(endpoint, batch)
+            created.extend((endpoint, obj['id'], obj['name']) for obj in batch_created)
+            for line_num, host, reason in batch_failed:
+                self.fail(line_num, host, reason)
+            print("Batch of {} {}: {} added, {} failed".format(len(batch), endpoint, len(batch_created), len(batch_failed)))
+
+            # a rejected batch costs extra requests to isolate the bad hosts, so shrink the next
+            # batches while they keep failing and grow them back once they go through cleanly,
+            # unless names were taken: then more of the file most likely exists already
+            if any(DUPLICATE_NAME_MESSAGE in reason for _, _, reason in batch_failed):
+                self.grow = False
+            if batch_failed:
+                self.size = max(1, self.size // 2)
+            elif self.grow:
+                self.size = min(self.batch_size, self.size * 2)
+        self.stats['created'] += len(created)
+        return created
+
+    # POST a batch in one bulk request.
+    # Returns the created objects and the (line number, host, reason) of every host that failed.
+    def send_batch(self, endpoint, batch):
+        try:
+            return self.post_batch(endpoint, batch), []
+        except FirepowerError as err:
+            if err.status_code is None:
+                raise
+            return self.split_batch(endpoint, batch, err)
+
+    def post_batch(self, endpoint, batch):
+        response = self.fmc.createObjects(endpoint, [host for _, host in batch], exit_on_error=False)
+        self.record(endpoint, response.get('items', []))
+        return response.get('items', [])
+
+    # The FMC rejects the whole batch if one host is bad, so a rejected batch is split in halves to isolate the bad hosts.
+    # Once both halves are rejected past MAX_SPLIT_DEPTH, e.g. on a rerun of the same file, the hosts are POSTed one by one.
+    def split_batch(self, endpoint, batch, err, depth=0):
+        if len(batch) == 1:
+            return [], [(batch[0][0], batch[0][1], error_description(err))]
+
+        middle = len(batch) // 2
+        created = []
+        rejected = []
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                created.extend(self.post_batch(endpoint, half))
+            except FirepowerError as half_err:
+                if half_err.status_code is None:
+                    raise
+                rejected.append((half, half_err))
+
+        failed = []
+        for half, half_err in rejected:
+            if len(rejected) == 2 and depth >= MAX_SPLIT_DEPTH and len(half) > 1:
+                half_created, half_failed = self.send_rows(endpoint, half)
+            else:
+                half_created, half_failed = self.split_batch(endpoint, half, half_err, depth + 1)
+            created.extend(half_created)
+            failed.extend(half_failed)
+        return created, failed
+
+    # PUT a changed host over the existing object
+    def update(self, line_num, existing, host):
+        object_json = {
+            'id': existing['id'],
+            'name': host['name'],
+            'type': existing['type'],
+            'value': host['value'],
+            'description': host['description'],
+        }
+        try:
+            self.fmc.updateObject(existing['endpoint'], existing['id'], object_json, exit_on_error=False)
+            print("Host " + host['name'] + " changed from " + existing['value'] + " to " + host['value'])
+            self.stats['updated'] += 1
+        except FirepowerError as err:
+            if err.status_code is None:
+                raise
+            self.fail(line_num, host, "update failed: " + error_description(err))
+
+    def report(self):
+        return ("{rows} valid rows, {invalid} invalid: {created} hosts added, {updated} updated, {unchanged} unchanged, "
+                "{repeated} repeated, {failed} failed").format(**self.stats)
+
+
+# delete the objects the journal recorded as created, newest first
+def rollback(fmc, journal):
+    created = list(reversed(journal.created()))
+    remaining = []
+    deleted = 0
+    print("Rolling back {} objects created by the import of {} ...".format(len(created), journal.source().get('file', 'an unknown file')))
+
+    for position, (endpoint, object_id, name) in enumerate(created):
+        try:
+            fmc.deleteObject(endpoint, object_id, exit_on_error=False)
+            deleted += 1
+        except FirepowerError as err:
+            if err.status_code is None:
+                # the FMC is unreachable, keep everything not deleted yet for the next attempt
+                remaining.extend(created[position:])
+                print("Error in connection --> " + str(err))
+                break
+            if err.status_code == 404:
+                print("Object " + name + " is gone already")
+                continue
+            # e.g. an object a group references by now
+            print("Object " + name + " could not be deleted: " + error_description(err))
+            remaining.append((endpoint, object_id, name))
+
+    if remaining:
+        # keep the objects left over for another --rollback, in creation order
+        journal.rewrite([dict(journal.source(), rollback=True), {'line': 0, 'created': list(reversed(remaining))}])
+        journal.close()
+        print("{} objects deleted, {} left in {} for another --rollback".format(deleted, len(remaining), journal.path))
+    else:
+        journal.remove()
+        print("{} objects deleted, the import is undone".format(deleted))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the network objects of a CSV file (name, value, description) to the FMC")
+    parser.add_argument('username', nargs='?', default=username)
+    parser.add_argument('password', nargs='?', default=password)
+    parser.add_argument('filename', nargs='?', default=filename)
+    parser.add_argument('--server', default=server, help="FMC IP address or name")
+    parser.add_argument('--bulk', action='store_true', help="POST the hosts in bulk requests instead of one by one")
+    parser.add_argument('--batch_size', type=int, default=MAX_BATCH_SIZE, help="hosts per bulk request, at most {}".format(MAX_BATCH_SIZE))
+    parser.add_argument('--upsert', action='store_true', help="index the existing networks, hosts and ranges first: create new names, update changed values, skip the rest")
+    parser.add_argument('--journal', help="journal of the import, <filename>.journal by default")
+    parser.add_argument('--resume', action='store_true', help="continue an interrupted import after the last chunk its journal committed")
+    parser.add_argument('--rollback', action='store_true', help="delete the objects the journal recorded as created")
+    args = parser.parse_args()
+
+    journal = ImportJournal(args.journal or args.filename + '.journal')
+
+    # work out where the import starts before logging in to the FMC
+    start_line = 0
+    resuming = False
+    if not args.rollback:
+        if journal.rolling_back():
+            print("Journal " + journal.path + " holds objects a rollback left behind, finish it with --rollback first")
+            return
+        if args.resume and journal.entries and not journal.finished():
+            source = journal.source()
+            if source.get('size') != os.path.getsize(args.filename) or source.get('mtime') != os.path.getmtime(args.filename):
+                print("Warning: " + args.filename + " changed since the interrupted import started")
+            start_line = journal.last_line()
+            resuming = True
+            print("Resuming the import after line {}".format(start_line))
+        elif args.resume:
+            print("No interrupted import in " + journal.path + ", starting from the top")
+        elif journal.entries and not journal.finished():
+            print("Journal " + journal.path + " holds an interrupted import, continue it with --resume or undo it with --rollback")
+            return
+
+    fmc = Firepower({
+        'FMC_IP': args.server.split("://")[-1],
+        'FMC_USER': args.username,
+        'FMC_PASS': args.password,
+        'SSL_VERIFY': False,
+        'SSL_CERT': None,
+    })
+
+    if args.rollback:
+        try:
+            if journal.entries:
+                rollback(fmc, journal)
+            else:
+                print("Nothing to roll back, there is no journal at " + journal.path)
+        finally:
+            fmc.close()
+        return
+
+    batch_size = max(1, min(args.batch_size, MAX_BATCH_SIZE))
+    importer = HostImporter(fmc, args.bulk, batch_size, build_name_index(fmc) if args.upsert else None, journal)
+
+    if resuming:
+        importer.resumed = set(name for _, _, name in journal.uncommitted())
+        journal.reopen()
+    else:
+        journal.start(args.filename)
+
+    print("Attempting to add Hosts from file " + args.filename + " ...")
+    try:
+        rows = read_hosts(args.filename, importer.stats, start_line)
+        for chunk in read_chunks(rows, batch_size if args.bulk else SINGLE_CHUNK_SIZE):
+            # a chunk is committed once all its rows went to the FMC, a crash repeats at most this chunk
+            importer.import_chunk(chunk)
+            journal.commit(chunk[-1][0])
+        journal.finish()
+    except FirepowerError as err:
+        print("Error in connection --> " + str(err))
+        print("Continue the import with --resume, or undo it with --rollback")
+    finally:
+        journal.close()
+        print(importer.report())
+        fmc.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import json
+import os
 import sys
-import requests
+
+# Reuse the FMC client shipped with the O365 feed parser, it shares the token cache and rate limiter with our other scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Firepower_O365_Feed_Parser-VERSION-3.0'))
+from Firepower import Firepower, FirepowerError
 
 server = ""
 
@@ -11,79 +15,38 @@ password = ""
 if len(sys.argv) > 2:
     password = sys.argv[2]
 
-r = None
-headers = {'Content-Type': 'application/json'}
-api_auth_path = "/api/fmc_platform/v1/auth/generatetoken"
-auth_url = server + api_auth_path
-try:
-    # 2 ways of making a REST call are provided:
-    # One with "SSL verification turned off" and the other with "SSL verification turned on".
-    # The one with "SSL verification turned off" is commented out. If you like to use that then
-    # uncomment the line where verify=False and comment the line with =verify='/path/to/ssl_certificate'
-    # REST call with SSL verification turned off:
-    r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,password), verify=False)
-    # REST call with SSL verification turned on: Download SSL certificates from your FMC first and provide its path for verification.
-    #r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username, password)
-    auth_headers = r.headers
-    auth_token = auth_headers.get('X-auth-access-token', default=None)       
-    if auth_token == None:
-        print("auth_token not found. Exiting...")
-        sys.exit()
-except Exception as err:
-    print("Error in generating auth token --> " + str(err))
-    sys.exit()
-
-headers['X-auth-access-token'] = auth_token
+# SSL verification turned off, set 'SSL_VERIFY': True and 'SSL_CERT': '/path/to/ssl_certificate' to turn it on
+fmc = Firepower({
+    'FMC_IP': server.split("://")[-1],
+    'FMC_USER': username,
+    'FMC_PASS': password,
+    'SSL_VERIFY': False,
+    'SSL_CERT': None,
+})
 
-api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/devices/devicerecords/f589875c-b6f8-11e6-ba9c-d259b84bf2d6/subinterfaces?expanded=true&limit=200"  # param
-url = server + api_path
-if (url[-1] == '/'):
-    url = url[:-1]
+device_path = "devices/devicerecords/f589875c-b6f8-11e6-ba9c-d259b84bf2d6"  # param
 
 # GET OPERATION
 
 try:
-    # REST call with SSL verification turned off:
-    r = requests.get(url, headers=headers, verify=False)
-    # REST call with SSL verification turned on:
-    #r = requests.get(url, headers=headers, verify='/path/to/ssl_certificate')
-    status_code = r.status_code
-    resp = r.text
-    if (status_code == 200):
-        print("GET successful. Response data --> ")
-        json_resp = json.loads(resp)
-        with open('data.csv','w') as f:
-            f.write(json.dumps(json_resp, ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
-    else:
-        r.raise_for_status()
-        print("Error occurred in GET --> " + resp)
-except requests.exceptions.HTTPError as err:
+    # follow the paging until every item is fetched, not just the first 200
+    json_resp = {'items': list(fmc.getAllItems(device_path + "/subinterfaces", exit_on_error=False))}
+    print("GET successful. Response data --> ")
+    with open('data.csv','w') as f:
+        f.write(json.dumps(json_resp, ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
+except FirepowerError as err:
     print("Error in connection --> " + str(err))
-    
-    
-api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/devices/devicerecords/f589875c-b6f8-11e6-ba9c-d259b84bf2d6/routing/staticroutes?expanded=true&limit=200"  # param
-url = server + api_path
-if (url[-1] == '/'):
-    url = url[:-1]
+
 
 # GET OPERATION
 
 try:
-    # REST call with SSL verification turned off:
-    r = requests.get(url, headers=headers, verify=False)
-    # REST call with SSL verification turned on:
-    #r = requests.get(url, headers=headers, verify='/path/to/ssl_certificate')
-    status_code = r.status_code
-    resp = r.text
-    if (status_code == 200):
-        print("GET successful. Response data --> ")
-        json_resp = json.loads(resp)
-        with open('data.csv','a') as f:
-            f.write(json.dumps(json_resp, ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
-    else:
-        r.raise_for_status()
-        print("Error occurred in GET --> " + resp)
-except requests.exceptions.HTTPError as err:
+    # follow the paging until every item is fetched, not just the first 200
+    json_resp = {'items': list(fmc.getAllItems(device_path + "/routing/staticroutes", exit_on_error=False))}
+    print("GET successful. Response data --> ")
+    with open('data.csv','a') as f:
+        f.write(json.dumps(json_resp, ensure_ascii=False, sort_keys=True, indent=4, separators=(',', ': ')))
+except FirepowerError as err:
     print("Error in connection --> " + str(err))
-finally:
-    if r: r.close()
+
+fmc.close()
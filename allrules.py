@@ -5,13 +5,21 @@
  
 import json
 import argparse
+import collections
+import os
 import sys
 import requests
-import time
 import logging
 import logging.handlers
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+# Reuse the FMC helpers shipped with the O365 feed parser
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Firepower_O365_Feed_Parser-VERSION-3.0'))
+from Firepower import pageItems
+from RateLimiter import RateLimiter
+from TokenManager import TokenManager
+from policy_snapshot import PolicySnapshot, SnapshotError, change_metadata
+
 
 server = ""
 username = ""
@@ -23,41 +31,73 @@ password = ""
 #if len(sys.argv) > 2:
 #    password = sys.argv[2]
 
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
 r = None
 headers = {'Content-Type': 'application/json'}
-api_auth_path = "/api/fmc_platform/v1/auth/generatetoken"
-auth_url = server + api_auth_path
-try:
-    # 2 ways of making a REST call are provided:
-    # One with "SSL verification turned off" and the other with "SSL verification turned on".
-    # The one with "SSL verification turned off" is commented out. If you like to use that then
-    # uncomment the line where verify=False and comment the line with =verify='/path/to/ssl_certificate'
-    # REST call with SSL verification turned off:
-    r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username,password), verify=False)
-    # REST call with SSL verification turned on: Download SSL certificates from your FMC first and provide its path for verification.
-    #r = requests.post(auth_url, headers=headers, auth=requests.auth.HTTPBasicAuth(username, password)
-    auth_headers = r.headers
-    auth_token = auth_headers.get('X-auth-access-token', default=None)       
-    if auth_token == None:
-        print("auth_token not found. Exiting...")
-        sys.exit()
-except Exception as err:
-    print("Error in generating auth token --> " + str(err))
-    sys.exit()
 
-headers['X-auth-access-token'] = auth_token
+headers['X-auth-access-token'] = None
+
+# One pooled session for all FMC calls, SSL verification turned off (verify='/path/to/ssl_certificate' to turn it on)
+session = requests.Session()
+session.verify = False
+
+token_manager = None
+
+# Every FMC call of this script waits for its turn under the FMC limit (120 requests/minute)
+rate_limiter = RateLimiter.shared(server.split("://")[-1])
+max_throttle_retries = 3
+
 
 LOGFILE_NAME = 'fmc_policy_complexity.log'
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 logger.propagate = False
 
+def generate_auth_token():
+    global token_manager
+
+    # The token is cached on disk and shared with our other FMC scripts, refreshed before it expires
+    if token_manager is None:
+        token_manager = TokenManager(server.split("://")[-1], username, password, session)
+
+    auth_token = token_manager.getToken()['access_token']
+    headers['X-auth-access-token'] = auth_token
+    return(auth_token)
+
+
+def refresh_auth_token():
+    # FMC rejected our token, refresh it once (or fetch a new one)
+    auth_token = token_manager.invalidate(headers['X-auth-access-token'])['access_token']
+    headers['X-auth-access-token'] = auth_token
+    return(auth_token)
+
 
 # General GET
 def make_api_get_request(url,headers):
     #print("API Call to: {}").format(url)
     logger.debug("API Call to: %s",url)
+    r = None
     try:
-        r = requests.get(url, headers=headers, verify=False)
+        generate_auth_token()
+        token_refreshed = False
+        throttled = 0
+        while True:
+            rate_limiter.acquire()
+            r = session.get(url, headers=headers, verify=session.verify)
+            if r.status_code == 401 and not token_refreshed:
+                # retry once with a refreshed token
+                r.close()
+                refresh_auth_token()
+                token_refreshed = True
+                continue
+            if r.status_code == 429 and throttled < max_throttle_retries:
+                # FMC is throttling us, back off as long as it asks
+                r.close()
+                wait = rate_limiter.throttle(r.headers.get('Retry-After'))
+                logger.info("FMC rate limit reached, retrying in %.1f seconds", wait)
+                throttled = throttled + 1
+                continue
+            break
         status_code = r.status_code
         resp = r.text
         if (status_code == 200):
@@ -75,66 +115,141 @@ def make_api_get_request(url,headers):
     return(json_resp)
 
 
+# Paged GET, yields every item of a collection url (no query string) as the pages arrive
+def get_all_items(url, limit=1000, expanded=False, prefetch=False):
+    def fetch_page(offset):
+        page_url = url + "?offset={}&limit={}&expanded={}".format(offset, limit, "true" if expanded else "false")
+        return make_api_get_request(page_url, headers)
+    return pageItems(fetch_page, prefetch)
+
+
 # GET OPERATION
 
 def get_rule_list(url, headers, accesspolicyid):
-    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid +"/accessrules?limit=200"
+    # yields all rules of the policy, not just the first 200
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid +"/accessrules"
     #api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/005056A0-BF7B-0ed3-0000-034359751006/accessrules?limit=200"    # param
     url = server + api_path
     if (url[-1] == '/'):
         url = url[:-1]
-    json_resp = make_api_get_request(url,headers)
 
-    return(json_resp)
+    return(get_all_items(url))
 
 
-def get_network_object_group_complexity(id, complexity):
-    #id: 005056A0-BF7B-0ed3-0000-034359748224
-    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/networkgroups/" + id    # param
-    url = server + api_path
-    if (url[-1] == '/'):
-        url = url[:-1]
-    #time.sleep(1)
-    json_resp = make_api_get_request(url, headers)
-    # check if network object is built in or not
-    if 'readOnly' in json_resp['metadata']:
-        for elem in json_resp['literals']:
-            if elem['type'] in ['Host', 'Network']:
-                #print elem['type']
-                complexity = complexity+1
-            elif elem['type'] in 'NetworkGroup':
-                #recursive call, help us universe
-                get_network_object_group_complexity(elem['id'],complexity)
-    # it is nomrmal cu configured object
-    else:
-        for elem in json_resp['objects']:
-            if elem['type'] in ['Host', 'Network']:
-                #print elem['type']
-                complexity = complexity+1
-            elif elem['type'] in 'NetworkGroup':
-                #recursive call, help us universe
-                get_network_object_group_complexity(elem['id'],complexity)
-    return complexity
+# UUID -> object json of the prefetched object tables, see prefetch_objects()
+object_index = {}
+PREFETCH_OBJECT_TYPES = ['networkgroups', 'portobjectgroups', 'networks', 'hosts', 'protocolportobjects']
+# object endpoint of each prefetched object type
+OBJECT_ENDPOINTS = {'NetworkGroup': 'networkgroups', 'PortObjectGroup': 'portobjectgroups', 'Network': 'networks',
+                    'Host': 'hosts', 'ProtocolPortObject': 'protocolportobjects'}
+# set when running from a snapshot, objects then never come from FMC
+offline = False
 
-def get_port_object_group_complexity(id, complexity):
-    #{"url":"/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/portobjectgroups/005056A0-BF7B-0ed3-0000-034359750457"}
-    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/portobjectgroups/" + id    # param
+
+def prefetch_objects():
+    # bulk download the object tables a few pages at a time, so groups resolve locally with no extra GETs
+    for object_type in PREFETCH_OBJECT_TYPES:
+        url = server + "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/" + object_type
+        object_cnt = 0
+        for obj in get_all_items(url, expanded=True, prefetch=True):
+            object_index[obj['id']] = obj
+            object_cnt = object_cnt + 1
+        logger.info("Prefetched %d %s", object_cnt, object_type)
+    print("Object index: {} objects prefetched".format(len(object_index)))
+
+
+def get_object(object_type, id):
+    # served from the prefetched index when we have it, else straight from FMC
+    if id in object_index:
+        return object_index[id]
+    if offline:
+        logger.warning("Object %s is not in the snapshot, counting it as empty", id)
+        return {'metadata': {}, 'objects': [], 'literals': []}
+    return fetch_object(object_type, id)
+
+
+def fetch_object(object_type, id):
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/" + object_type + "/" + id    # param
     url = server + api_path
     if (url[-1] == '/'):
         url = url[:-1]
+    return make_api_get_request(url, headers)
+
+
+# Per-run memo of flattened group members, keyed by group UUID, so a group
+# shared by many rules (e.g. RFC1918) is fetched once per crawl. The memo holds
+# the set of member keys rather than a count, so a member reached through two
+# nested groups, or round a nesting loop, is only counted once
+network_group_cache = {}
+port_group_cache = {}
+group_cache_hits = 0
+# groups being resolved right now, outermost first, a group met again while in here is nested in itself
+groups_in_progress = []
+# shallowest position in groups_in_progress met again by the group being resolved
+group_cycle_depth = None
+
+
+def group_member_key(elem):
+    # objects by UUID, literals (which have no UUID) by type and value
+    if 'id' in elem:
+        return elem['id']
+    return elem['type'] + ':' + elem.get('value', '')
+
+
+def flatten_group(id, object_type, group_type, cache, leaf_types=None):
+    # the member keys of a group and of every group nested in it
+    global group_cache_hits, group_cycle_depth
+    if id in cache:
+        group_cache_hits = group_cache_hits + 1
+        return cache[id]
+    if id in groups_in_progress:
+        logger.warning("%s %s is nested in itself, not counting it again", group_type, id)
+        depth = groups_in_progress.index(id)
+        if group_cycle_depth is None or depth < group_cycle_depth:
+            group_cycle_depth = depth
+        return set()
+
+    depth = len(groups_in_progress)
+    outer_cycle_depth = group_cycle_depth
+    group_cycle_depth = None
+    groups_in_progress.append(id)
+    try:
+        json_resp = get_object(object_type, id)
+        members = set()
+        # built in (readOnly) network groups only have literals, configured groups can have objects and literals
+        for elem in json_resp.get('literals', []) + json_resp.get('objects', []):
+            if elem['type'] == group_type:
+                # nested group, add its flattened members
+                logger.debug("%s %s, dig into it", group_type, elem['id'])
+                members |= flatten_group(elem['id'], object_type, group_type, cache, leaf_types)
+            elif leaf_types is None or elem['type'] in leaf_types:
+                members.add(group_member_key(elem))
+    finally:
+        groups_in_progress.pop()
+        # only a loop back to one of the groups enclosing this one leaves them partial too
+        partial = group_cycle_depth is not None and group_cycle_depth < depth
+        if partial and (outer_cycle_depth is None or group_cycle_depth < outer_cycle_depth):
+            outer_cycle_depth = group_cycle_depth
+        group_cycle_depth = outer_cycle_depth
 
-    json_resp = make_api_get_request(url, headers)
+    # a group that met one of the groups enclosing it only has part of its members (the
+    # enclosing group's are missing), so it is left for its own lookup to resolve in full
+    if not partial:
+        cache[id] = members
+    return members
 
-    for elem in json_resp['objects']:
-        if elem['type'] in 'PortObjectGroup':
-            #recursive call, help us universe
-            print("port object, dig into it")
-            get_port_object_group_complexity(elem['id'],complexity)
-        else:
-            #print elem['type']
-            complexity = complexity+1
 
-    return complexity
+def get_network_object_group_complexity(id, complexity):
+    #id: 005056A0-BF7B-0ed3-0000-034359748224
+    return complexity + len(flatten_group(id, 'networkgroups', 'NetworkGroup', network_group_cache, ['Host', 'Network']))
+
+def get_port_object_group_complexity(id, complexity):
+    #{"url":"/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/portobjectgroups/005056A0-BF7B-0ed3-0000-034359750457"}
+    return complexity + len(flatten_group(id, 'portobjectgroups', 'PortObjectGroup', port_group_cache))
+
+def group_cache_report():
+    return "Group cache: {} network groups, {} port groups fetched, {} lookups served from cache".format(
+        len(network_group_cache), len(port_group_cache), group_cache_hits)
 
 def get_single_rule_complexity(ruleid, accesspolicyid):
     #print("Getting single rule complexity: " + ruleid)
@@ -143,6 +258,17 @@ def get_single_rule_complexity(ruleid, accesspolicyid):
     api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid +"/accessrules/" + ruleid
     url = server + api_path
     
+    logger.info('Getting single rule complexity: %s', ruleid)
+
+    json_resp = make_api_get_request(url, headers)
+
+    get_rule_complexity(json_resp)
+
+    return(json_resp)
+
+
+def get_rule_complexity(json_resp):
+    # counts complexity of a rule json, either a single rule GET or an item of the expanded rule listing
     total_complexity = 0
     src_zones = 0
     dst_zones = 0
@@ -151,10 +277,6 @@ def get_single_rule_complexity(ruleid, accesspolicyid):
     dst_ports = 0
     vlan_tags = 1 # later usage, now its mainly not measured vlanTags:{}
     
-    logger.info('Getting single rule complexity: %s' + ruleid)
-
-    json_resp = make_api_get_request(url, headers)
-
     # do counting and return it
     if 'sourceZones' in json_resp:
         src_zones = len(json_resp['sourceZones']['objects'])
@@ -221,28 +343,212 @@ def get_single_rule_complexity(ruleid, accesspolicyid):
         dst_networks = 1
 
     comp = src_zones * dst_zones * src_networks * dst_networks * dst_ports
-    print("{} \t {} \t {} \t {} \t {} \t {} \t {} \t {} \t {}").format(json_resp['metadata']['accessPolicy']['name'],json_resp['name'], json_resp['id'], src_zones, dst_zones, src_networks, dst_networks, dst_ports, comp)
+    print("{} \t {} \t {} \t {} \t {} \t {} \t {} \t {} \t {}".format(json_resp['metadata'].get('accessPolicy', {}).get('name'),json_resp['name'], json_resp['id'], src_zones, dst_zones, src_networks, dst_networks, dst_ports, comp))
 
-    return(json_resp)
+    return(comp)
 
 
 def get_all_rule_complexity(accesspolicyid, headers):
     #005056A0-BF7B-0ed3-0000-034359751006
-    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid + "/accessrules?limit=200"    # param
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid + "/accessrules"    # param
     url = server + api_path
     if (url[-1] == '/'):
         url = url[:-1]
-    json_resp = make_api_get_request(url,headers)
-    # json_resp is already a dict
-    #print(json_resp['items'])
     print("==== Policy Complexity Summary ====")
     print("Policy Name \t Rule Name \t Rule ID \t SourceZoneCount \t DestinationZoneCount \t SourceNetworkCount \t DestinationNetworkCount \t DestinationPortCount \t Total Complexity")
-        
-    for elem in json_resp['items']:
+
+    # page through all rules, the next page is fetched while we score the current one
+    for elem in get_all_items(url, prefetch=True):
         #print("ID: {} | Name: {} | Link: {}").format(elem['id'], elem['name'], elem['links']['self'])
         res = get_single_rule_complexity(elem['id'], accesspolicyid)
-        #print("sleeping not to kill API...")
-        time.sleep(5)
+
+    # the shared rate limiter paces the calls, no blind sleeps needed
+    print(group_cache_report())
+    print(rate_limiter.report())
+
+
+def get_all_rule_complexity_bulk(accesspolicyid):
+    # the expanded listing already carries zones, networks and ports of every rule,
+    # so the whole policy costs one GET per 1000 rules instead of one GET per rule
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid + "/accessrules"    # param
+    url = server + api_path
+    print_policy_complexity(get_all_items(url, expanded=True, prefetch=True))
+    print(rate_limiter.report())
+
+
+def print_policy_complexity(rules):
+    # complexity summary of expanded rule jsons, from the FMC listing or a snapshot
+    print("==== Policy Complexity Summary ====")
+    print("Policy Name \t Rule Name \t Rule ID \t SourceZoneCount \t DestinationZoneCount \t SourceNetworkCount \t DestinationNetworkCount \t DestinationPortCount \t Total Complexity")
+
+    rule_cnt = 0
+    total_complexity = 0
+    for rule in rules:
+        total_complexity = total_complexity + get_rule_complexity(rule)
+        rule_cnt = rule_cnt + 1
+
+    print("Rules: {} \t Policy Complexity: {}".format(rule_cnt, total_complexity))
+    print(group_cache_report())
+
+
+def referenced_objects(rule):
+    # network and port objects a rule points at (UUID -> type), zones are not objects we score
+    refs = {}
+    for field in ['sourceNetworks', 'destinationNetworks', 'sourcePorts', 'destinationPorts']:
+        for obj in rule.get(field, {}).get('objects', []):
+            refs[obj['id']] = obj['type']
+    return refs
+
+
+def collect_referenced_objects(refs):
+    # walk the groups down to their members, returns every object (UUID -> type) reachable from refs
+    seen = {}
+    pending = list(refs.items())
+    while pending:
+        object_id, object_type = pending.pop()
+        if object_id in seen:
+            continue
+        seen[object_id] = object_type
+        obj = object_index.get(object_id)
+        if obj:
+            pending.extend((member['id'], member['type']) for member in obj.get('objects', []))
+    return seen
+
+
+def take_snapshot(accesspolicyid, path):
+    # fetch the policy once: its rules from the expanded listing and every object they reference
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid + "/accessrules"    # param
+    url = server + api_path
+
+    if not object_index:
+        prefetch_objects()
+
+    snapshot = PolicySnapshot(path, create=True)
+    snapshot.clear()
+
+    rule_refs = {}
+    for position, rule in enumerate(get_all_items(url, expanded=True, prefetch=True)):
+        snapshot.put_rule(accesspolicyid, position, rule)
+        rule_refs.update(referenced_objects(rule))
+
+    for object_id in collect_referenced_objects(rule_refs):
+        obj = object_index.get(object_id)
+        if obj:
+            snapshot.put_object(OBJECT_ENDPOINTS.get(obj['type']), obj)
+        else:
+            logger.warning("Object %s referenced by the policy was not prefetched", object_id)
+
+    snapshot.mark_taken(accesspolicyid)
+    print(snapshot.summary())
+    snapshot.close()
+    print(rate_limiter.report())
+
+
+def diff_listing(url, stored, new_items=True):
+    # compares an FMC listing with the stored (timestamp, last user) of each UUID
+    # returns the listing (UUID -> item, in FMC order), the changed or new UUIDs, the deleted UUIDs
+    # and whether the listing is expanded, i.e. its items are complete and need no extra GET
+    listing = get_all_items(url)
+    current = collections.OrderedDict((item['id'], item) for item in listing)
+    expanded = False
+    if current and 'metadata' not in next(iter(current.values())):
+        # this FMC leaves the metadata out of the lightweight listing, diff on the expanded pages instead
+        logger.info("No metadata in the listing of %s, using the expanded listing", url)
+        current = collections.OrderedDict((item['id'], item) for item in get_all_items(url, expanded=True, prefetch=True))
+        expanded = True
+
+    changed = []
+    for item_id, item in current.items():
+        if item_id not in stored:
+            if new_items:
+                changed.append(item_id)
+        elif change_metadata(item) != tuple(stored[item_id]) or stored[item_id][0] is None:
+            changed.append(item_id)
+    deleted = [item_id for item_id in stored if item_id not in current]
+    return current, changed, deleted, expanded
+
+
+def open_snapshot(path):
+    # an existing snapshot, stops here when the file is missing or holds no snapshot
+    try:
+        return PolicySnapshot(path)
+    except SnapshotError as err:
+        print(str(err))
+        sys.exit(1)
+
+
+def refresh_snapshot(path):
+    # brings a snapshot up to date, only changed or new rules and objects are fetched again
+    snapshot = open_snapshot(path)
+    accesspolicyid = snapshot.get_meta('policy_id')
+    fetched_cnt = 0
+    tombstone_cnt = 0
+
+    # rules, in their current policy order
+    api_path = "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/policy/accesspolicies/" + accesspolicyid + "/accessrules"    # param
+    url = server + api_path
+    current, changed, deleted, expanded = diff_listing(url, snapshot.rule_metadata(accesspolicyid))
+    changed = set(changed)
+    for position, rule_id in enumerate(current):
+        if rule_id in changed:
+            rule = current[rule_id] if expanded else make_api_get_request(url + "/" + rule_id, headers)
+            snapshot.put_rule(accesspolicyid, position, rule)
+            fetched_cnt = fetched_cnt + 1
+        else:
+            snapshot.set_rule_position(rule_id, position)
+    for rule_id in deleted:
+        snapshot.tombstone_rule(rule_id)
+        tombstone_cnt = tombstone_cnt + 1
+
+    # objects we already hold, objects FMC has but the policy doesn't use are left out
+    for object_type in PREFETCH_OBJECT_TYPES:
+        stored = snapshot.object_metadata(object_type)
+        if not stored:
+            continue
+        url = server + "/api/fmc_config/v1/domain/e276abec-e0f2-11e3-8169-6d9ed49b625f/object/" + object_type
+        current, changed, deleted, expanded = diff_listing(url, stored, new_items=False)
+        for object_id in changed:
+            obj = current[object_id] if expanded else fetch_object(object_type, object_id)
+            snapshot.put_object(object_type, obj)
+            fetched_cnt = fetched_cnt + 1
+        for object_id in deleted:
+            snapshot.tombstone_object(object_id)
+            tombstone_cnt = tombstone_cnt + 1
+
+    # objects the changed rules and groups reference that we don't hold yet
+    object_index.update(snapshot.object_index())
+    attempted = set()
+    while True:
+        rule_refs = {}
+        for rule in snapshot.iter_rules(accesspolicyid):
+            rule_refs.update(referenced_objects(rule))
+        missing = [(object_id, object_type) for object_id, object_type in collect_referenced_objects(rule_refs).items()
+                   if object_id not in object_index and object_id not in attempted and object_type in OBJECT_ENDPOINTS]
+        if not missing:
+            break
+        for object_id, object_type in missing:
+            attempted.add(object_id)
+            obj = fetch_object(OBJECT_ENDPOINTS[object_type], object_id)
+            object_index[object_id] = obj
+            snapshot.put_object(OBJECT_ENDPOINTS[object_type], obj)
+            fetched_cnt = fetched_cnt + 1
+
+    snapshot.mark_refreshed()
+    print("Refresh: {} rules/objects fetched, {} tombstoned".format(fetched_cnt, tombstone_cnt))
+    print(snapshot.summary())
+    snapshot.close()
+    print(rate_limiter.report())
+
+
+def load_snapshot(path):
+    # the reports then run against the snapshot, no FMC needed
+    global offline
+    snapshot = open_snapshot(path)
+    object_index.update(snapshot.object_index())
+    offline = True
+    print(snapshot.summary())
+    return snapshot
+
 
 def main():
     """
@@ -260,7 +566,12 @@ def main():
     parser.add_argument("-no", "--network_object_id", help="Get network object ID")
     parser.add_argument("-po", "--port_object_id", help="Get port object ID")
     parser.add_argument("--list_all", help="Get complexity of all rules inside the policy")
+    parser.add_argument("--bulk", action="store_true", help="With --list_all, read all rules from the expanded rule listing instead of one GET per rule")
+    parser.add_argument("--prefetch_objects", action="store_true", help="Download all network/port objects and groups up front and resolve groups locally")
     parser.add_argument("--incremental_rules", help="Calculate rule complexity starting rule id in -r, for policy specified in -ap, takes max increment cnt")
+    parser.add_argument("--snapshot", help="Save the policy, its rules and every referenced object to this snapshot file")
+    parser.add_argument("--refresh_snapshot", help="Update this snapshot file, fetching only rules and objects changed on FMC since")
+    parser.add_argument("--from_snapshot", help="Run --list_all, --rule_id and --network_object_id against this snapshot file, without FMC")
 
     args = parser.parse_args()
    
@@ -277,23 +588,51 @@ def main():
     accesspolicyid = args.accesspolicy_id #'005056A0-BF7B-0ed3-0000-034359751006'
     ruleid = '005056A0-BF7B-0ed3-0000-000268437889'
     
-    if not headers['X-auth-access-token']:
+    snapshot = None
+    if args.from_snapshot:
+        snapshot = load_snapshot(args.from_snapshot)
+        accesspolicyid = snapshot.get_meta('policy_id')
+    elif not headers['X-auth-access-token']:
         print("no x-auht token, generating it")
         generate_auth_token()
 
-    if args.accesspolicy_id:
+    if args.accesspolicy_id and not snapshot:
         accesspolicyid = args.accesspolicy_id
 
+    if args.prefetch_objects and not snapshot:
+        prefetch_objects()
+
+    if args.snapshot:
+        take_snapshot(accesspolicyid, args.snapshot)
+
+    if args.refresh_snapshot:
+        refresh_snapshot(args.refresh_snapshot)
+
     if args.rule_id and not args.incremental_rules:
-        print("Getting single rulle id: {}").format(args.rule_id)
-        get_single_rule_complexity(ruleid=args.rule_id, accesspolicyid=accesspolicyid)
+        print("Getting single rulle id: {}".format(args.rule_id))
+        if snapshot:
+            rule = snapshot.get_rule(args.rule_id)
+            if rule:
+                get_rule_complexity(rule)
+            else:
+                print("rule {} is not in the snapshot".format(args.rule_id))
+        else:
+            get_single_rule_complexity(ruleid=args.rule_id, accesspolicyid=accesspolicyid)
 
     if args.network_object_id:
-        get_network_object_group_complexity(args.network_object_id, 0)
+        print("Network group {} flattened member count: {}".format(args.network_object_id, get_network_object_group_complexity(args.network_object_id, 0)))
 
-    if args.list_all:
+    if args.list_all and snapshot:
+        print_policy_complexity(snapshot.iter_rules(accesspolicyid))
+    elif args.list_all and args.bulk:
+        get_all_rule_complexity_bulk(accesspolicyid)
+    elif args.list_all:
         get_all_rule_complexity(accesspolicyid, headers)
 
+    if args.incremental_rules and snapshot:
+        print("--incremental_rules crawls FMC live, it can't run from a snapshot")
+        sys.exit()
+
     if args.incremental_rules:
         # incremental rule crawl starting form args.rule_id
         rules_max = int(args.incremental_rules)
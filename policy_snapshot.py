@@ -0,0 +1,166 @@
+#
+# Local snapshot of an FMC access policy, its rules and referenced objects
+# Lets the policy complexity reports run offline, see allrules.py --snapshot / --from_snapshot
+#
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS rules (
+    id TEXT PRIMARY KEY,
+    policy_id TEXT,
+    position INTEGER,
+    timestamp TEXT,
+    last_user TEXT,
+    deleted INTEGER DEFAULT 0,
+    json BLOB
+);
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    object_type TEXT,
+    timestamp TEXT,
+    last_user TEXT,
+    deleted INTEGER DEFAULT 0,
+    json BLOB
+);
+CREATE INDEX IF NOT EXISTS rules_policy ON rules (policy_id, position);
+"""
+
+
+def pack(obj):
+    # objects are stored as compressed compact json
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def change_metadata(obj):
+    # FMC change metadata of an object or rule, (timestamp, last user name)
+    metadata = obj.get('metadata', {})
+    last_user = metadata.get('lastUser', {})
+    timestamp = metadata.get('timestamp')
+    return (str(timestamp) if timestamp is not None else None, last_user.get('name'))
+
+
+class SnapshotError(Exception):
+    # the file is missing, not a snapshot or never had a policy saved to it
+    pass
+
+
+class PolicySnapshot(object):
+
+    def __init__(self, path, create=False):
+        # only a new snapshot (create=True) may start from a missing or empty file,
+        # sqlite would otherwise quietly create an empty database for a mistyped path
+        self.path = path
+        if not create and not os.path.isfile(path):
+            raise SnapshotError("No snapshot file {}, take one with --snapshot first".format(path))
+        self.db = sqlite3.connect(path)
+        try:
+            if not create:
+                self.check_taken()
+            self.db.executescript(SCHEMA)
+        except sqlite3.DatabaseError as err:
+            self.db.close()
+            raise SnapshotError("{} is not a snapshot file: {}".format(path, err))
+        except SnapshotError:
+            self.db.close()
+            raise
+
+    def check_taken(self):
+        # an existing file has to hold a snapshot before we touch it
+        if not self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone() \
+                or self.get_meta('policy_id') is None:
+            raise SnapshotError("{} holds no policy snapshot, take one with --snapshot first".format(self.path))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def clear(self):
+        # start a fresh snapshot in an existing file
+        self.db.execute("DELETE FROM rules")
+        self.db.execute("DELETE FROM objects")
+        self.db.execute("DELETE FROM meta")
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put_rule(self, policy_id, position, rule):
+        timestamp, last_user = change_metadata(rule)
+        self.db.execute("INSERT OR REPLACE INTO rules (id, policy_id, position, timestamp, last_user, deleted, json) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                        (rule['id'], policy_id, position, timestamp, last_user, pack(rule)))
+
+    def put_object(self, object_type, obj):
+        timestamp, last_user = change_metadata(obj)
+        self.db.execute("INSERT OR REPLACE INTO objects (id, object_type, timestamp, last_user, deleted, json) VALUES (?, ?, ?, ?, 0, ?)",
+                        (obj['id'], object_type, timestamp, last_user, pack(obj)))
+
+    def set_rule_position(self, rule_id, position):
+        self.db.execute("UPDATE rules SET position = ? WHERE id = ?", (position, rule_id))
+
+    def tombstone_rule(self, rule_id):
+        # deleted holds the time the rule disappeared from FMC, 0 while it is live
+        self.db.execute("UPDATE rules SET deleted = ? WHERE id = ? AND deleted = 0", (int(time.time()), rule_id))
+
+    def tombstone_object(self, object_id):
+        self.db.execute("UPDATE objects SET deleted = ? WHERE id = ? AND deleted = 0", (int(time.time()), object_id))
+
+    def rule_metadata(self, policy_id):
+        # UUID -> (timestamp, last user) of the live rules of the policy
+        return dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            "SELECT id, timestamp, last_user FROM rules WHERE policy_id = ? AND deleted = 0", (policy_id,)))
+
+    def object_metadata(self, object_type):
+        # UUID -> (timestamp, last user) of the live objects of one object type
+        return dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            "SELECT id, timestamp, last_user FROM objects WHERE object_type = ? AND deleted = 0", (object_type,)))
+
+    def get_rule(self, rule_id):
+        row = self.db.execute("SELECT json FROM rules WHERE id = ? AND deleted = 0", (rule_id,)).fetchone()
+        return unpack(row[0]) if row else None
+
+    def iter_rules(self, policy_id):
+        # rules of the policy in policy order
+        for row in self.db.execute("SELECT json FROM rules WHERE policy_id = ? AND deleted = 0 ORDER BY position", (policy_id,)):
+            yield unpack(row[0])
+
+    def get_object(self, object_id):
+        row = self.db.execute("SELECT json FROM objects WHERE id = ? AND deleted = 0", (object_id,)).fetchone()
+        return unpack(row[0]) if row else None
+
+    def object_index(self):
+        # UUID -> object json of every live object in the snapshot
+        return dict((row[0], unpack(row[1])) for row in self.db.execute("SELECT id, json FROM objects WHERE deleted = 0"))
+
+    def mark_taken(self, policy_id):
+        self.set_meta('policy_id', policy_id)
+        self.set_meta('taken_at', time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def mark_refreshed(self):
+        self.set_meta('refreshed_at', time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def summary(self):
+        rule_cnt = self.db.execute("SELECT COUNT(*) FROM rules WHERE deleted = 0").fetchone()[0]
+        object_cnt = self.db.execute("SELECT COUNT(*) FROM objects WHERE deleted = 0").fetchone()[0]
+        tombstone_cnt = self.db.execute("SELECT (SELECT COUNT(*) FROM rules WHERE deleted != 0) + (SELECT COUNT(*) FROM objects WHERE deleted != 0)").fetchone()[0]
+        return "Snapshot {}: policy {} taken {}, refreshed {}, {} rules, {} objects, {} tombstones".format(
+            self.path, self.get_meta('policy_id'), self.get_meta('taken_at'), self.get_meta('refreshed_at'), rule_cnt, object_cnt, tombstone_cnt)